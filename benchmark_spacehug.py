@@ -0,0 +1,240 @@
+# Benchmarks of test_case_spacehug pipeline stages
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+import test_case_spacehug
+
+# In the order main() does them, output stages are only done if asked for and the map is not too big for them
+LAYOUT_STAGES = ('get_array_size', 'locate_array_center', 'get_coordinates_delta', 'index_chunks', 'fill_chunks_map',
+                 'place_applications', 'pan_coordinates', 'get_canvas_dimensions')
+OUTPUT_STAGES = ('to_json', 'output_json', 'output_image')
+DEFAULT_SIZES = (10, 100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+def stage_call(appmap, stage, layout_engine, directory):
+    """
+    Figures out what to call for the stage of the pipeline and with what
+    """
+    if stage == 'place_applications' and layout_engine == 'numpy':
+        return appmap.place_applications_vectorized, ()
+
+    if stage == 'output_json':
+        return appmap.output_json, (os.path.join(directory, 'matrix.json'),)
+
+    if stage == 'output_image':
+        return appmap.output_image, (os.path.join(directory, 'image.png'),)
+
+    return getattr(appmap, stage), ()
+
+
+def run_pipeline(size, stages, layout_engine, directory, trace=False):
+    """
+    Runs the pipeline on a new map of given size, returns measurements of every stage asked for
+    Untraced runs measure wall time and memory blocks the stage left allocated, which is not all it has allocated.
+    Traced runs measure peak memory allocated while the stage runs instead, their timings are off because of tracing
+    """
+    appmap = test_case_spacehug.Map(size)
+    measurements = {}
+
+    for stage in LAYOUT_STAGES + OUTPUT_STAGES:
+        if stage in OUTPUT_STAGES and stage not in stages:
+            continue
+
+        function, arguments = stage_call(appmap, stage, layout_engine, directory)
+        gc.collect()
+
+        if trace:
+            tracemalloc.start()
+            function(*arguments)
+            measurements[stage] = {'peak_bytes': tracemalloc.get_traced_memory()[1]}
+            # Stopping clears the traces, so the next stage peak does not include this one
+            tracemalloc.stop()
+
+        else:
+            retained_blocks = sys.getallocatedblocks()
+            start_time = timeit.default_timer()
+            function(*arguments)
+            measurements[stage] = {'seconds': timeit.default_timer() - start_time,
+                                   'retained_blocks': sys.getallocatedblocks() - retained_blocks}
+
+    return {stage: measurement for stage, measurement in measurements.items() if stage in stages}
+
+
+def benchmark(sizes, stages, layout_engine='python', repeat=3, memory=True, limits=None):
+    """
+    Benchmarks stages of the pipeline on maps of all the sizes, yields a result for every size and stage
+    The fastest of repeated runs is taken for the time, as slower ones are slowed down by something else
+    """
+    limits = limits or {}
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        for size in sizes:
+            # Output stages of too big maps would take ages or all the memory there is
+            sized_stages = [stage for stage in stages if size <= limits.get(stage, size)]
+            runs = [run_pipeline(size, sized_stages, layout_engine, directory) for _ in range(repeat)]
+            traced = run_pipeline(size, sized_stages, layout_engine, directory, trace=True) if memory else {}
+
+            for stage in sized_stages:
+                fastest = min(runs, key=lambda run: run[stage]['seconds'])[stage]
+                result = {'size': size, 'stage': stage, 'seconds': fastest['seconds'],
+                          'retained_blocks': fastest['retained_blocks']}
+
+                if memory:
+                    result['peak_bytes'] = traced[stage]['peak_bytes']
+
+                yield result
+
+
+def compare(results, baseline, threshold, min_seconds=0.001):
+    """
+    Compares results to the baseline ones, returns the list of regressions as human readable strings
+    Time regresses if it is more than threshold slower and not just by a tiny bit, peak memory if it is more than
+    threshold bigger. Stages and sizes missing from the baseline are not compared
+    """
+    baseline_results = {(result['size'], result['stage']): result for result in baseline['results']}
+    regressions = []
+
+    for result in results:
+        base = baseline_results.get((result['size'], result['stage']))
+
+        if base is None:
+            continue
+
+        if result['seconds'] > base['seconds'] * (1 + threshold) and result['seconds'] - base['seconds'] > min_seconds:
+            regressions.append(f'{result["stage"]} of {result["size"]} applications: '
+                               f'{result["seconds"]:.4f} s, was {base["seconds"]:.4f} s')
+
+        if 'peak_bytes' in result and 'peak_bytes' in base and \
+                result['peak_bytes'] > base['peak_bytes'] * (1 + threshold):
+            regressions.append(f'{result["stage"]} of {result["size"]} applications: '
+                               f'{result["peak_bytes"]} bytes at peak, was {base["peak_bytes"]} bytes')
+
+    return regressions
+
+
+def main():
+
+    def check_integer_list(value):
+        """
+        Input validation for list of sizes, comma separated positive integers
+        """
+        if not all(size.isdigit() for size in value.split(',')):
+            raise argparse.ArgumentTypeError(f'{value} is not a valid comma separated list of positive integers')
+
+        return [int(size) for size in value.split(',')]
+
+    def check_stages(value):
+        """
+        Input validation for list of stages, comma separated stage names
+        """
+        stages = value.split(',')
+        unknown = [stage for stage in stages if stage not in LAYOUT_STAGES + OUTPUT_STAGES]
+
+        if unknown:
+            raise argparse.ArgumentTypeError(f'unknown stages: {", ".join(unknown)}')
+
+        return stages
+
+    arg_parser = argparse.ArgumentParser(description='Benchmarks test_case_spacehug pipeline stage by stage',
+                                         prog='benchmark_spacehug')
+
+    arg_parser.add_argument('-s', '--sizes',
+                            dest='sizes',
+                            type=check_integer_list,
+                            default=list(DEFAULT_SIZES),
+                            help='Amounts of applications to benchmark, 10 to 10000000 by default')
+
+    arg_parser.add_argument('-st', '--stages',
+                            dest='stages',
+                            type=check_stages,
+                            default=list(LAYOUT_STAGES + OUTPUT_STAGES),
+                            help='Stages to report, all of them by default')
+
+    arg_parser.add_argument('-l', '--layout-engine',
+                            dest='layout_engine',
+                            choices=('python', 'numpy'),
+                            default='python',
+                            help='Layout engine to place applications with')
+
+    arg_parser.add_argument('-r', '--repeat',
+                            dest='repeat',
+                            type=int,
+                            default=3,
+                            help='Runs per size, the fastest one counts, 3 by default')
+
+    arg_parser.add_argument('-nm', '--no-memory',
+                            dest='memory',
+                            action='store_false',
+                            help='Do not do the traced run measuring peak memory, it is way slower than the others')
+
+    arg_parser.add_argument('-jl', '--to-json-limit',
+                            dest='to_json_limit',
+                            type=int,
+                            default=1000000,
+                            help='Biggest map to do to_json on, it holds the whole dict in memory, 1000000 by default')
+
+    arg_parser.add_argument('-il', '--image-limit',
+                            dest='image_limit',
+                            type=int,
+                            default=10000,
+                            help='Biggest map to draw the image of, 10000 by default')
+
+    arg_parser.add_argument('-o', '--output',
+                            dest='output_file',
+                            help='Write results to json file with given name, to be used as a baseline later')
+
+    arg_parser.add_argument('-b', '--baseline',
+                            dest='baseline_file',
+                            help='Compare results to json file with given name and exit with 1 if anything regressed')
+
+    arg_parser.add_argument('-t', '--threshold',
+                            dest='threshold',
+                            type=float,
+                            default=0.2,
+                            help='How much slower or bigger is a regression, 0.2 (20%%) by default')
+
+    command_line = arg_parser.parse_args()
+    limits = {'to_json': command_line.to_json_limit, 'output_image': command_line.image_limit}
+    results = []
+
+    print(f'{"size":>10} {"stage":<24} {"seconds":>10} {"retained blocks":>16} {"peak bytes":>12}')
+
+    for result in benchmark(command_line.sizes, command_line.stages, command_line.layout_engine,
+                            command_line.repeat, command_line.memory, limits):
+        results.append(result)
+        print(f'{result["size"]:>10} {result["stage"]:<24} {result["seconds"]:>10.4f} '
+              f'{result["retained_blocks"]:>16} {result.get("peak_bytes", "-"):>12}', flush=True)
+
+    report = {'python': platform.python_version(),
+              'platform': platform.platform(),
+              'layout_engine': command_line.layout_engine,
+              'repeat': command_line.repeat,
+              'results': results}
+
+    if command_line.output_file:
+        with open(command_line.output_file, 'w') as out_file:
+            json.dump(report, out_file, indent=2)
+
+    if command_line.baseline_file:
+        with open(command_line.baseline_file) as in_file:
+            regressions = compare(results, json.load(in_file), command_line.threshold)
+
+        for regression in regressions:
+            print(f'REGRESSION: {regression}')
+
+        if regressions:
+            sys.exit(1)
+
+        print('No regressions')
+
+
+if __name__ == '__main__':
+    main()
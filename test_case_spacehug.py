@@ -1,351 +1,2353 @@
 # Test case for JetStyle; Exec.: Dmitri Y. Lapshin
-from PIL import Image, ImageDraw, ImageFont
+from array import array
+from collections.abc import Mapping
 import argparse
+import bisect
+import collections
+import functools
+import gzip
+import io
+import itertools
 import json
 import logging
+import math
+import os
+import signal
+import struct
+import sys
 import timeit
+import zlib
+
+# Modules only some of the modes need (NumPy, multiprocessing, asyncio and so on) are imported where they are used,
+# so that json-only runs do not spend their startup on them
 
 __VERSION__ = '0.0.1'
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d.%m.%Y %H:%M:%S', level=logging.INFO)
 logger = logging.getLogger(__name__)
+Image = ImageChops = ImageDraw = ImageFont = None                      # Pillow is imported by import_pillow()
 
 
-class Map:
+@functools.lru_cache(maxsize=None)
+def import_pillow():
     """
-    Constucts a map of applications from given amount
-    Builds json-matrix
-    Outputs an image based off the json-matrix in jpeg format
+    Imports Pillow on first use, once per process, so runs which draw nothing do not spend their startup on it
     """
+    global Image, ImageChops, ImageDraw, ImageFont
+    from PIL import Image, ImageChops, ImageDraw, ImageFont
 
-    def __init__(self, applications_amount):
+
+class Coordinates(Mapping):
+    """
+    Compact storage of application coordinates
+    Keeps x and y of every slot of every chunk in one flat array of doubles, so application N lives in slot N - 1
+    Works as read-only mapping of application to [x, y], in the same order the applications were placed in
+    Panning is a single offset which is applied on read, the stored coordinates are never rewritten
+    """
+
+    def __init__(self, applications_amount=0, chunk_size=12, slots=None, extent=None):
+        self.applications_amount = applications_amount
+        self.chunk_size = chunk_size
+        self.slots = array('d') if slots is None else slots           # x0, y0, x1, y1, ... of every slot
+        self.offset = [0.0, 0.0]                                      # Pan offset
+        self.extent = extent                                          # [min_x, min_y, max_x, max_y], not panned
+
+        if self.extent is None and len(self.slots):
+            self.measure()
+
+    def __len__(self):
+
+        return self.applications_amount + self.has_zero()
+
+    def __iter__(self):
+        yield from range(1, self.applications_amount + 1)
+
+        if self.has_zero():
+            yield 0
+
+    def __getitem__(self, application):
+        index = self.slot_index(application)
+
+        return [self.slots[index] + self.offset[0], self.slots[index + 1] + self.offset[1]]
+
+    def has_zero(self):
         """
-        Initializes the map
+        Zero-filled slots of the last chunk are placed too, the last one of them is what the zero application is at
         """
-        # Given the initial dimensions (196, 98, 350):
-        self.large_horisontal = 350.0                                 # Object (house) dimensions
-        self.large_half_horisontal = 175.0                            #
-        self.large_vertical = 175.0                                   #
-        self.large_half_vertical = 87.5                               #
-        self.small_horisontal = 175.0                                 # Gap dimensions
-        self.small_vertical = 87.5                                    #
-        self.chunk_horisontal = 1750.0                                # Chunk (block of houses) dimensions
-        self.chunk_half_horisontal = 875.0                            #
-        self.chunk_vertical = 875.0                                   #
-        self.chunk_half_vertical = 437.5                              #
-        self.chunk_center_coordinate = [875.0, 437.5]                 # Chunk (block of houses) center
-        self.array_size = 0
-        self.array_center = [0, 0]
-        self.coordinates_delta = []
-        self.map = []
-        self.apps_coordinates = {}
-        self.canvas_dimensions = []
-        self.json_data = {}
-        self.applications_amount = applications_amount                # Data from command line '-a'
-        self.applications = list(range(1, applications_amount + 1))   # The list of applications to arrange
-        self.chunk_size = 12                                          # Amount of applications per chunk
-        self.chunks = list(self.split_applications())                 # Applications arranged by chunk
-        self.chunks_structure = list(self.split_applications())       # Applications arranged by chunk and parity
-        self.chunks_amount = len(self.chunks)                         # Total amount of chunks
+        return bool(self.applications_amount % self.chunk_size)
+
+    def slot_index(self, application):
+        """
+        Figures out where the application coordinates are in the slots array
+        """
+        if 0 < application <= self.applications_amount:
+            return 2 * (application - 1)
+
+        elif application == 0 and self.has_zero():
+            return len(self.slots) - 2
+
+        raise KeyError(application)
+
+    def points(self):
+        """
+        Yields (application, x, y) of all the applications in order, panned
+        """
+        dx, dy = self.offset
+        slots = iter(self.slots)
+
+        for application, x, y in zip(range(1, self.applications_amount + 1), slots, slots):
+            yield application, x + dx, y + dy
+
+        if self.has_zero():
+            yield 0, self.slots[-2] + dx, self.slots[-1] + dy
+
+    def place(self, application, point):
+        """
+        Stores coordinates of the next slot and keeps track of the extent while doing so
+        """
+        self.slots.extend(point)
+
+        # Zero-filled slots are not in the map, except for the last one
+        if not application and len(self.slots) // 2 % self.chunk_size:
+            return
+
+        x, y = point
+
+        if self.extent is None:
+            self.extent = [x, y, x, y]
+
+        else:
+            extent = self.extent
+
+            if x < extent[0]:
+                extent[0] = x
+
+            elif x > extent[2]:
+                extent[2] = x
+
+            if y < extent[1]:
+                extent[1] = y
+
+            elif y > extent[3]:
+                extent[3] = y
+
+    def measure(self):
+        """
+        Figures out the extent of already stored slots in one pass, when they were not placed one by one
+        """
+        # Only the real applications and the zero one, the rest of zero-filled slots are not in the map
+        xs = self.slots[0:2 * self.applications_amount:2]
+        ys = self.slots[1:2 * self.applications_amount:2]
+
+        if self.has_zero():
+            xs.append(self.slots[-2])
+            ys.append(self.slots[-1])
+
+        self.extent = [min(xs), min(ys), max(xs), max(ys)]
+
+    def bounds(self):
+        """
+        Returns panned [min_x, min_y, max_x, max_y] or None if there is nothing placed
+        """
+        if self.extent is None:
+            return None
+
+        dx, dy = self.offset
+
+        return [self.extent[0] + dx, self.extent[1] + dy, self.extent[2] + dx, self.extent[3] + dy]
+
+    def pan(self, dx, dy):
+        """
+        Shifts all the coordinates, lazily
+        """
+        self.offset = [self.offset[0] + dx, self.offset[1] + dy]
+
+
+def write_json(out_file, canvas_dimensions, points, batch_size=4096):
+    """
+    Streams json matrix to the file object, batch by batch, so the whole document is never held in memory
+    The output is the same as json.dumps() of canvas dimensions and application coordinates dict
+    """
+    out_file.write(f'{{"canvas_dimensions": {json.dumps(canvas_dimensions)}, "application_coordinates": {{')
+    separator = ''
+
+    while True:
+        # float.__repr__() is exactly what json uses for floats
+        batch = [f'"{application}": [{x!r}, {y!r}]' for application, x, y in itertools.islice(points, batch_size)]
+
+        if not batch:
+            break
+
+        out_file.write(separator + ', '.join(batch))
+        separator = ', '
+
+    out_file.write('}}')
+
+
+class BinaryMatrix(Mapping):
+    """
+    Memory-mapped reader of binary json-matrix counterpart, written by Map.output_binary()
+    The file is a header followed by packed little-endian doubles: x and y of application 0 (NaN if there is none),
+    then x and y of applications 1 to N. Coordinates are stored as placed, the pan offset from the header is applied
+    on read. Works as read-only mapping of application to [x, y], just like Coordinates
+    """
+    # Magic, version, chunk size, amount of applications, canvas dimensions, pan offset, extent (not panned)
+    header = struct.Struct('<4sHHQII6d')
+    magic = b'TCSM'
+    version = 1
+
+    def __init__(self, filename):
+        import mmap
+
+        with open(filename, 'rb') as in_file:
+            # Empty files can not be mapped at all
+            if os.fstat(in_file.fileno()).st_size < self.header.size:
+                raise ValueError(f'{filename} is not a binary json-matrix')
+
+            self.buffer = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.chunk_size, self.applications_amount, width, height, *rest = \
+            self.header.unpack_from(self.buffer)
+
+        if magic != self.magic or version != self.version or not self.chunk_size:
+            self.close()
+            raise ValueError(f'{filename} is not a binary json-matrix of version {self.version}')
+
+        # Header, the zero application and the rest of them
+        size = self.header.size + 16 * (self.applications_amount + 1)
+
+        if len(self.buffer) != size:
+            length = len(self.buffer)
+            self.close()
+            raise ValueError(f'{filename} is {length} bytes long, {size} bytes expected for '
+                             f'{self.applications_amount} applications, it is truncated or corrupt')
+
+        self.canvas_dimensions = [width, height]
+        self.offset = rest[:2]
+        self.extent = None if math.isnan(rest[2]) else list(rest[2:])
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+
+        return self.applications_amount + self.has_zero()
+
+    def __iter__(self):
+        yield from range(1, self.applications_amount + 1)
+
+        if self.has_zero():
+            yield 0
+
+    def __getitem__(self, application):
+        if not (0 < application <= self.applications_amount or application == 0 and self.has_zero()):
+            raise KeyError(application)
+
+        x, y = struct.unpack_from('<2d', self.buffer, self.header.size + 16 * application)
+
+        return [x + self.offset[0], y + self.offset[1]]
+
+    def has_zero(self):
+        """
+        Same as Coordinates.has_zero()
+        """
+        return bool(self.applications_amount % self.chunk_size)
+
+    def points(self, batch_size=4096):
+        """
+        Yields (application, x, y) of all the applications in order, panned
+        The file is read batch by batch into bytes, so no view of the buffer is left behind to keep it from closing,
+        even if the caller stops halfway
+        """
+        dx, dy = self.offset
+        # Skipping the zero application, it goes last
+        start = self.header.size + 16
+
+        for first in range(1, self.applications_amount + 1, batch_size):
+            last = min(first + batch_size, self.applications_amount + 1)
+            pairs = struct.iter_unpack('<2d', self.buffer[start + 16 * (first - 1):start + 16 * (last - 1)])
+
+            for application, (x, y) in zip(range(first, last), pairs):
+                yield application, x + dx, y + dy
+
+        if self.has_zero():
+            yield (0, *self[0])
+
+    def output_json(self, filename, compress=False):
+        """
+        Converts binary json-matrix back to the json one
+        """
+        with (gzip.open(filename, 'wt') if compress else open(filename, 'w')) as out_file:
+            write_json(out_file, self.canvas_dimensions, self.points())
+
+    def close(self):
+        self.buffer.close()
+
+
+class TileStamp:
+    """
+    Pre-rendered application tile to stamp over the image
+    The polygon is rasterized once and every character of the labels is rendered once, so the only thing left to
+    draw for each application is its label, composed out of the cached character sprites
+    """
+    padding = 8                                                       # Room for glyph parts sticking out of the box
+
+    def __init__(self, font, dimensions):
+        import_pillow()
+        self.font = font
+        self.dimensions = dimensions
+        width, height = dimensions
+        self.tile = Image.new('RGBA', dimensions)
+        # Used tint of blue to indicate transparency, resulting polygon should be purple-ish
+        ImageDraw.Draw(self.tile).polygon([(width / 2, 0), (width, height / 2), (width / 2, height), (0, height / 2)],
+                                          fill=(0, 0, 127, 127),
+                                          outline=(0, 0, 127, 255))
+        self.sprites = {}                                             # (character, subpixel start) -> 'L' mask
+        self.extents = {}                                             # Character -> its (width, height)
+        self.cutouts = {}                                             # Label box -> (tile without the box, the box)
+        self.prefix = (None, None)                                    # Last composed label prefix and its mask
+        # Composing labels out of sprites only works for fonts with no kerning and whole pixel advances (like
+        # Verdana digits are), otherwise the labels are rendered as they are
+        probe = ''.join(f'{a}{b}' for a in '0123456789' for b in '0123456789')
+        self.composable = True
+        self.composable = self.label(probe)[0].tobytes() == self.render(probe)[0].tobytes()
+
+    def sprite(self, character, start):
+        """
+        Renders a single character the same way ImageDraw.text() renders it at the given subpixel start
+        """
+        key = (character, start)
+
+        if key not in self.sprites:
+            self.sprites[key] = self.render(character, start)[0]
+
+        return self.sprites[key]
+
+    def extent(self, character):
+        """
+        Measures a single character, font.getsize() is way too slow to be called for every label
+        """
+        if character not in self.extents:
+            self.extents[character] = self.font.getsize(character)
+
+        return self.extents[character]
+
+    def place(self, w, h):
+        """
+        Figures out where the label of given dimensions goes: its position in the tile and subpixel start
+        """
+        # The text is placed in the center of polygon accounting for text dimensions
+        x = (self.dimensions[0] - w) / 2
+        y = (self.dimensions[1] - h) / 2
+
+        return (math.floor(x) - self.padding, math.floor(y) - self.padding), (x - math.floor(x), y - math.floor(y))
+
+    def render(self, text, start=None):
+        """
+        Renders the label mask with ImageDraw.text() itself
+        Returns the mask and its position inside the tile
+        """
+        w, h = self.font.getsize(text)
+        position, label_start = self.place(w, h)
+        mask = Image.new('L', (w + 2 * self.padding, h + 2 * self.padding))
+        start = label_start if start is None else start
+        ImageDraw.Draw(mask).text((self.padding + start[0], self.padding + start[1]), text, fill=255, font=self.font)
+
+        return mask, position
+
+    def label(self, text):
+        """
+        Composes the label mask out of character sprites
+        Returns the mask and its position inside the tile
+        """
+        if not self.composable:
+            return self.render(text)
+
+        # Labels are runs of digits, which have the same advance and no kerning, so the run is measured by glyphs
+        extents = [self.extent(character) for character in text]
+        w = sum(extent[0] for extent in extents)
+        h = max(extent[1] for extent in extents)
+        position, start = self.place(w, h)
+        # Applications go in order, so the labels share everything but the last character ten times in a row
+        key = (text[:-1], w, h)
+
+        if self.prefix[0] != key:
+            mask = Image.new('L', (w + 2 * self.padding, h + 2 * self.padding))
+            self.compose(mask, text[:-1], start, 0)
+            self.prefix = (key, mask)
+
+        mask = self.prefix[1].copy()
+        self.compose(mask, text[-1:], start, w - extents[-1][0])
+
+        return mask, position
+
+    def compose(self, mask, text, start, pen):
+        """
+        Adds character sprites to the label mask starting at given pen position
+        """
+        for character in text:
+            sprite = self.sprite(character, start)
+            box = (pen, 0, pen + sprite.size[0], sprite.size[1])
+            # Glyphs may overlap a bit, the same way they do when rendered as a run
+            mask.paste(ImageChops.lighter(mask.crop(box), sprite), box)
+            pen += self.extents[character][0]
+
+    def cutout(self, box):
+        """
+        Splits the tile into the tile with the label box cut out (fully transparent) and the label box itself
+        """
+        if box not in self.cutouts:
+            holed = self.tile.copy()
+            holed.paste((0, 0, 0, 0), box)
+            self.cutouts[box] = (holed, self.tile.crop(box))
+
+        return self.cutouts[box]
+
+    def paste(self, background, text, offset):
+        """
+        Stamps the tile with the text over background at given offset
+        Same as pasting the tile with the text drawn over it, only the label box is drawn from scratch
+        """
+        mask, (x, y) = self.label(text)
+        box = (max(x, 0), max(y, 0), min(x + mask.size[0], self.dimensions[0]),
+               min(y + mask.size[1], self.dimensions[1]))
+        holed, label_box = self.cutout(box)
+        label_box = label_box.copy()
+        label_box.paste((255, 255, 255, 255), (x - box[0], y - box[1]), mask)
+        background.paste(holed, offset, mask=holed)
+        background.paste(label_box, (offset[0] + box[0], offset[1] + box[1]), mask=label_box)
+
+
+class SpatialIndex:
+    """
+    Grid bucket index of application coordinates for point and viewport queries
+    The map is split into cells of the polygon size, so any point is covered only by the polygons centered in its own
+    cell or in the 8 cells around it. The index is built over coordinates as placed, so panning does not spoil it
+    """
+
+    def __init__(self, coordinates, half_width, half_height):
+        self.coordinates = coordinates
+        self.half_width = half_width
+        self.half_height = half_height
+        self.cells = {}                                               # (column, row) -> applications in the cell
+        self.bounds = None                                            # First and last column and row with any cells
+        slots = iter(coordinates.slots)
+
+        for application, x, y in zip(range(1, coordinates.applications_amount + 1), slots, slots):
+            self.cells.setdefault(self.cell(x, y), []).append(application)
+
+        if coordinates.has_zero():
+            self.cells.setdefault(self.cell(*coordinates.slots[-2:]), []).append(0)
+
+        if self.cells:
+            columns = [column for column, _ in self.cells]
+            rows = [row for _, row in self.cells]
+            self.bounds = [min(columns), min(rows), max(columns), max(rows)]
+
+    def cell(self, x, y):
+        """
+        Figures out the cell the point is in
+        """
+        return int(x // (2 * self.half_width)), int(y // (2 * self.half_height))
+
+    def order(self, application):
+        """
+        Figures out the order the application is drawn in, the zero one goes last
+        """
+        return application or self.coordinates.applications_amount + 1
+
+    def raw(self, application):
+        """
+        Coordinates of the application as placed
+        """
+        index = self.coordinates.slot_index(application)
+
+        return self.coordinates.slots[index], self.coordinates.slots[index + 1]
+
+    def add(self, application):
+        """
+        Adds the application placed after the index was built
+        """
+        column, row = self.cell(*self.raw(application))
+        self.cells.setdefault((column, row), []).append(application)
+
+        if self.bounds is None:
+            self.bounds = [column, row, column, row]
+
+        else:
+            self.bounds = [min(self.bounds[0], column), min(self.bounds[1], row),
+                           max(self.bounds[2], column), max(self.bounds[3], row)]
+
+    def discard(self, application):
+        """
+        Removes the application from the index, before it is moved
+        """
+        self.cells[self.cell(*self.raw(application))].remove(application)
+
+    def candidates(self, min_x, min_y, max_x, max_y):
+        """
+        Yields applications from all the cells the given (not panned) rectangle touches
+        The rectangle is clamped to the cells there are, and if it still covers more cells than there are, the cells
+        are looked through instead, so the query never costs more than the whole index, however big the rectangle is
+        """
+        if self.bounds is None or any(math.isnan(value) for value in (min_x, min_y, max_x, max_y)):
+            return
+
+        width = 2 * self.half_width
+        height = 2 * self.half_height
+        # Clamping the coordinates first keeps infinite ones away from cell()
+        min_x = max(min_x, self.bounds[0] * width)
+        min_y = max(min_y, self.bounds[1] * height)
+        max_x = min(max_x, (self.bounds[2] + 1) * width)
+        max_y = min(max_y, (self.bounds[3] + 1) * height)
+
+        if min_x > max_x or min_y > max_y:
+            return
+
+        first_column, first_row = self.cell(min_x, min_y)
+        last_column, last_row = self.cell(max_x, max_y)
+        first_column, first_row = max(first_column, self.bounds[0]), max(first_row, self.bounds[1])
+        last_column, last_row = min(last_column, self.bounds[2]), min(last_row, self.bounds[3])
+
+        if (last_column - first_column + 1) * (last_row - first_row + 1) > len(self.cells):
+
+            for (column, row), applications in self.cells.items():
+                if first_column <= column <= last_column and first_row <= row <= last_row:
+                    yield from applications
+
+            return
+
+        for column in range(first_column, last_column + 1):
+
+            for row in range(first_row, last_row + 1):
+                yield from self.cells.get((column, row), ())
+
+    def at(self, x, y):
+        """
+        Figures out the application which polygon covers the point, the one drawn last if there is a few of them
+        Returns None if there is none
+        """
+        x -= self.coordinates.offset[0]
+        y -= self.coordinates.offset[1]
+        found = None
+
+        for application in self.candidates(x - self.half_width, y - self.half_height,
+                                           x + self.half_width, y + self.half_height):
+            center_x, center_y = self.raw(application)
+
+            if abs(x - center_x) / self.half_width + abs(y - center_y) / self.half_height <= 1 and \
+                    (found is None or self.order(application) > self.order(found)):
+                found = application
+
+        return found
+
+    def within(self, min_x, min_y, max_x, max_y):
+        """
+        Figures out the applications which polygon bounding boxes overlap the rectangle, in the order they are drawn
+        """
+        min_x -= self.coordinates.offset[0]
+        max_x -= self.coordinates.offset[0]
+        min_y -= self.coordinates.offset[1]
+        max_y -= self.coordinates.offset[1]
+        found = []
+
+        for application in self.candidates(min_x - self.half_width, min_y - self.half_height,
+                                           max_x + self.half_width, max_y + self.half_height):
+            center_x, center_y = self.raw(application)
+
+            if center_x - self.half_width < max_x and center_x + self.half_width > min_x and \
+                    center_y - self.half_height < max_y and center_y + self.half_height > min_y:
+                found.append(application)
+
+        found.sort(key=self.order)
+
+        return found
+
+
+def deflate_rows(pixels, stride):
+    """
+    Filters and compresses raw RGBA pixels of whole rows into a piece of PNG image data, see PngWriter
+    Returns raw deflate data ending on a byte boundary, so pieces compressed apart can be just concatenated, along
+    with adler32 and length of the uncompressed rows, which PngWriter needs for the zlib trailer
+    """
+    # Every row goes with no filtering
+    rows = b''.join(b'\x00' + pixels[start:start + stride] for start in range(0, len(pixels), stride))
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    return compressor.compress(rows) + compressor.flush(zlib.Z_SYNC_FLUSH), zlib.adler32(rows), len(rows)
+
+
+def adler32_combine(adler1, adler2, length2):
+    """
+    Figures out adler32 of two pieces of data put together from adler32 of both and length of the second one
+    """
+    base = 65521
+    a1, b1 = adler1 & 0xffff, adler1 >> 16
+    a2, b2 = adler2 & 0xffff, adler2 >> 16
+    a = (a1 + a2 - 1) % base
+    b = (b1 + b2 + length2 * (a1 - 1)) % base
+
+    return b << 16 | a
+
+
+class PngWriter:
+    """
+    Writes RGBA PNG image band by band, so the whole image is never held in memory
+    Bands are compressed by deflate_rows() on their own (in the worker processes drawing them, for one), the writer
+    only puts the pieces together into a single zlib stream
+    """
+
+    def __init__(self, out_file, width, height):
+        self.out_file = out_file
+        self.stride = width * 4                                       # Bytes per row
+        self.adler = 1                                                # Adler32 of nothing
+        self.out_file.write(b'\x89PNG\r\n\x1a\n')
+        # 8 bits per channel, RGBA, no interlacing
+        self.chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+        # Zlib header: deflate with 32K window, default compression
+        self.chunk(b'IDAT', b'\x78\x9c')
+
+    def chunk(self, kind, data):
+        """
+        Writes a single PNG chunk
+        """
+        self.out_file.write(struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data)))
+
+    def write(self, pixels):
+        """
+        Compresses raw RGBA pixels of the next whole rows and writes them out
+        """
+        self.write_deflated(*deflate_rows(pixels, self.stride))
+
+    def write_deflated(self, data, adler, length):
+        """
+        Writes out the next whole rows, compressed by deflate_rows() already
+        """
+        self.adler = adler32_combine(self.adler, adler, length)
+
+        if data:
+            self.chunk(b'IDAT', data)
+
+    def close(self):
+        # Final empty deflate block, then adler32 of all the rows
+        self.chunk(b'IDAT', b'\x03\x00' + struct.pack('>I', self.adler))
+        self.chunk(b'IEND', b'')
+
+
+@functools.lru_cache(maxsize=None)
+def load_font():
+    """
+    Loads the font for application labels, once per process
+    """
+    import_pillow()
+    # If on Windows, 'Windows/fonts/' folder is looked into
+    return ImageFont.truetype('verdana.ttf', 48)
+
+
+@functools.lru_cache(maxsize=None)
+def load_stamp(dimensions):
+    """
+    Pre-renders the tile of given dimensions, once per process
+    """
+    return TileStamp(load_font(), dimensions)
+
+
+def render_band(band):
+    """
+    Draws a single horizontal band of the image and returns it compressed by deflate_rows()
+    Runs in the worker processes, so everything it needs comes in the band itself
+    """
+    top, dimensions, polygon_dimensions, stamps = band
+    import_pillow()
+    # Used tint of red to indicate transparency
+    background = Image.new('RGBA', dimensions, (127, 0, 0, 0))
+    stamp = load_stamp(polygon_dimensions)
+
+    for text, x, y in stamps:
+        stamp.paste(background, text, (x, y - top))
+
+    return deflate_rows(background.tobytes(), dimensions[0] * 4)
+
+
+class lazy_attribute:
+    """
+    Computes the attribute on first access and stores it in the instance, so it is computed once at most
+    The same as functools.cached_property, which Python 3.6 does not have yet
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.__doc__ = function.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        value = instance.__dict__[self.function.__name__] = self.function(instance)
+
+        return value
+
+
+def spiral_sum(count, head, extra):
+    """
+    Adds up first count deltas of one coordinate of the spiral built by get_coordinates_delta(), in closed form
+    The deltas are the head ones, then rings: 2k - 1 + extra ones, k zeroes, 2k + extra minus ones and k zeroes
+    """
+    if count <= len(head):
+        return sum(head[:count])
+
+    total = sum(head)
+    count -= len(head)
+
+    # Every ring k takes 6 * k - 1 + 2 * extra deltas
+    def before(k):
+
+        return 3 * k * (k - 1) + (2 * extra - 1) * (k - 1)
+
+    ring = int(math.sqrt(count // 3)) + 1
+
+    while before(ring + 1) <= count:
+        ring += 1
+
+    while before(ring) > count:
+        ring -= 1
+
+    # Every full ring adds up to -1
+    total -= ring - 1
+    taken = count - before(ring)
+    ones = 2 * ring - 1 + extra
+
+    return total + min(taken, ones) - min(max(taken - ones - ring, 0), 2 * ring + extra)
+
+
+def spiral_position(chunk_number):
+    """
+    Figures out the position of the chunk relative to the chunks map center, the same as index_chunks() does
+    Chunks are numbered from 0 here, -1 stands for the position before the first chunk
+    """
+    return spiral_sum(chunk_number + 1, [0], 0), spiral_sum(chunk_number + 1, [0, -1], 1)
+
+
+def spiral_deltas(head, extra):
+    """
+    Yields the delta sequence spiral_sum() adds up, one step at a time and forever
+    """
+    yield from head
+
+    for ring in itertools.count(1):
+        yield from itertools.repeat(1, 2 * ring - 1 + extra)
+        yield from itertools.repeat(0, ring)
+        yield from itertools.repeat(-1, 2 * ring + extra)
+        yield from itertools.repeat(0, ring)
+
+
+def spiral_positions():
+    """
+    Yields positions of all the chunks starting from the first one, the same as spiral_position() does, in O(1) each
+    """
+    return zip(itertools.accumulate(spiral_deltas([0], 0)), itertools.accumulate(spiral_deltas([0, -1], 1)))
+
+
+def spiral_deltas_array(numpy, count, head, extra):
+    """
+    Vectorized counterpart of spiral_deltas(), returns first count deltas as NumPy array
+    """
+    # Every ring k takes 6 * k - 1 + 2 * extra deltas, so that many rings is always enough
+    rings = numpy.arange(1, int(math.sqrt(count / 3)) + 3)
+    lengths = numpy.column_stack((2 * rings - 1 + extra, rings, 2 * rings + extra, rings)).ravel()
+    deltas = numpy.repeat(numpy.tile(numpy.array([1, 0, -1, 0], dtype=numpy.int64), len(rings)), lengths)
+
+    return numpy.concatenate((numpy.array(head, dtype=numpy.int64), deltas))[:count]
+
+
+def spiral_positions_array(numpy, count):
+    """
+    Vectorized counterpart of spiral_positions(), returns positions of the first count chunks as (count, 2) array
+    """
+    return numpy.column_stack((numpy.cumsum(spiral_deltas_array(numpy, count, [0], 0)),
+                               numpy.cumsum(spiral_deltas_array(numpy, count, [0, -1], 1))))
+
+
+class Map:
+    """
+    Constucts a map of applications from given amount
+    Builds json-matrix
+    Outputs an image based off the json-matrix in jpeg format
+    """
+    tiles_cache_size = 64                                             # Upper level tiles kept by render_tile()
+
+    def __init__(self, applications_amount):
+        """
+        Initializes the map
+        """
+        # Given the initial dimensions (196, 98, 350):
+        self.large_horisontal = 350.0                                 # Object (house) dimensions
+        self.large_half_horisontal = 175.0                            #
+        self.large_vertical = 175.0                                   #
+        self.large_half_vertical = 87.5                               #
+        self.small_horisontal = 175.0                                 # Gap dimensions
+        self.small_vertical = 87.5                                    #
+        self.chunk_horisontal = 1750.0                                # Chunk (block of houses) dimensions
+        self.chunk_half_horisontal = 875.0                            #
+        self.chunk_vertical = 875.0                                   #
+        self.chunk_half_vertical = 437.5                              #
+        self.chunk_center_coordinate = [875.0, 437.5]                 # Chunk (block of houses) center
+        self.array_size = 0
+        self.array_center = [0, 0]
+        self.apps_coordinates = Coordinates()
+        self.spatial_index = None
+        self.canvas_dimensions = []
+        self.tiles_cache = collections.OrderedDict()                  # Upper level tiles render_tile() has drawn
+        self.json_data = {}
+        self.applications_amount = applications_amount                # Data from command line '-a'
+        self.chunk_size = 12                                          # Amount of applications per chunk
+        self.chunks_amount = -(-applications_amount // self.chunk_size)  # Total amount of chunks
+        # The lists of applications and chunks below are only built when asked for
+
+    @lazy_attribute
+    def coordinates_delta(self):
+        """
+        Chunk to chunk position deltas, see get_coordinates_delta()
+        """
+        self.get_coordinates_delta()
+
+        return self.coordinates_delta
+
+    @lazy_attribute
+    def chunks_index(self):
+        """
+        Chunk positions and parity, see index_chunks()
+        """
+        self.index_chunks()
+
+        return self.chunks_index
+
+    @lazy_attribute
+    def map(self):
+        """
+        Chunks map, see fill_chunks_map()
+        """
+        self.get_array_size()
+        self.locate_array_center()
+        self.fill_chunks_map()
+
+        return self.map
+
+    @lazy_attribute
+    def applications(self):
+        """
+        The list of applications to arrange
+        """
+        return list(range(1, self.applications_amount + 1))
+
+    @lazy_attribute
+    def chunks(self):
+        """
+        Applications arranged by chunk
+        """
+        return list(self.split_applications())
+
+    @lazy_attribute
+    def chunks_structure(self):
+        """
+        Applications arranged by chunk and parity
+        """
+        return list(self.split_applications())
+
+    def is_built(self, name):
+        """
+        Tells whether the lazy attribute is built already
+        """
+        return name in self.__dict__
+
+    def __repr__(self):
+
+        return f'Blocks: {self.chunks_amount}\n' \
+               f'Array size: {self.array_size} x {self.array_size}\n' \
+               f'Array center coordinates: {self.array_center}\n' \
+               f'Chunks map: {self.map}\n' \
+               f'Objects map: {self.chunks_structure}'
+
+    def split_applications(self):
+        """
+        Yield successive chunk_size-sized chunks from applications
+        """
+        apps = self.applications[:]                                   # Blind-copying the list, not referencing it
+        for position in range(0, len(apps), self.chunk_size):         # Splitting the list to even-sized chunks
+            result = apps[position:position + self.chunk_size]
+
+            if len(result) == 12:
+                yield result
+
+            else:
+                yield result + [0] * (self.chunk_size - len(result))  # Fills the rest of chunk with zeroes
+
+    def split_chunk(self, chunk_number):
+        """
+        The same as split_applications() does, but for a single chunk and without the list of applications
+        """
+        first = chunk_number * self.chunk_size + 1
+        result = list(range(first, min(first + self.chunk_size, self.applications_amount + 1)))
+
+        return result + [0] * (self.chunk_size - len(result))
+
+    def get_array_size(self):
+        """
+        Figures out what the chunk map square side is, we need it for parity calculation later on
+        """
+        chunks_count = self.chunks_amount - 1                         # We need to subtract 1 so no excessive space is
+        k = 0                                                         # created in the map (i.e. no zero-border)
+
+        while chunks_count > 0:
+            k += 1
+            chunks_count -= 6 * k
+
+        self.array_size = 2 * k + 1
+
+    def locate_array_center(self):
+        """
+        Figures out the coordinates of center of chunks map array to start building chunks around it
+        """
+        coordinate = self.array_size // 2
+        self.array_center = [coordinate, coordinate]
+
+    def get_coordinates_delta(self):
+        """
+        Calculates coordinates delta for each chunk in relation to the previous chunk,
+        so we can build a chunks map like this:
+
+        [0, 0, 19, 8, 9]
+        [0, 18, 7, 2, 10]
+        [17, 6, 1, 3, 11]
+        [16, 5, 4, 12, 0]
+        [15, 14, 13, 0, 0]
+
+        """
+        x = [0]                                                       # X differs from Y coordinate delta for the first
+        x_ones = 1                                                    # two elements, along with different order
+        x_zeroes = 1                                                  # That is due to the order the chunks are placed
+        y = [0, -1]                                                   # in
+        y_ones = 2                                                    #
+        y_zeroes = 1                                                  #
+
+        while len(x) <= self.chunks_amount:
+            x += ([1] * x_ones + [0] * x_zeroes + [-1] * (x_ones + 1) + [0] * x_zeroes)
+            x_ones += 2
+            x_zeroes += 1
+
+        while len(y) <= self.chunks_amount:
+            y += ([1] * y_ones + [0] * y_zeroes + [-1] * (y_ones + 1) + [0] * y_zeroes)
+            y_ones += 2
+            y_zeroes += 1
+
+        self.coordinates_delta = [delta for delta in zip(x[:self.chunks_amount], y[:self.chunks_amount])]
+
+    def fill_chunks_map(self):
+        """
+        Fills the map with chunk's IDs
+        """
+        # Time to prearrange template for chunks
+        self.map = [[0] * self.array_size for _ in range(self.array_size)]
+        x, y = self.array_center
+
+        # Filling the map using chunk positions from index_chunks()
+        for chunk, (dx, dy, _) in enumerate(self.chunks_index):
+            self.map[y + dy][x + dx] = chunk + 1
+
+    def index_chunks(self):
+        """
+        Builds chunk index: chunk position relative to the array center and its parity, so we don't have to scan
+        the whole chunks map every time we need to know whether the chunk is odd or not
+        """
+        self.chunks_index = []
+        x = 0
+        y = 0
+
+        for dx, dy in self.coordinates_delta:
+            x += dx
+            y += dy
+            # The chunk is odd if its flat index in the map is even. The map side is always odd,
+            # so flat index parity is just the parity of x + y (the center offsets cancel each other out)
+            self.chunks_index.append((x, y, not (x + y) % 2))
+
+    def chunk_is_odd(self, chunk_number):
+        """
+        Figures out whether the chunk is odd (and the applications in it should be in "reversed" order) or not
+        """
+        # There is no "zero" chunks, chunks are numbered from 1
+        if 0 < chunk_number <= self.chunks_amount:
+            # Not building the index just for that, parity is the same as index_chunks() figures out
+            x, y = self.chunk_position(chunk_number - 1)
+
+            return not (x + y) % 2
+
+    def chunk_shift(self, delta):
+        """
+        Figures out how to shift chunk center coordinate to place applications later on
+        """
+        # Since there is only 6 possible ways to shift coordinates in the hexagonal spiral design (permutation of
+        # -1, 0 and 1 without repetition can produce only 6 different tuples):
+
+        # straight right shift
+        if delta == (1, -1):
+            return [self.chunk_horisontal - self.small_horisontal, 0]
+
+        # down-left shift
+        elif delta == (0, 1):
+            return [- self.chunk_half_horisontal + self.small_horisontal * 0.5,
+                    self.chunk_half_vertical - self.small_vertical * 0.5]
+
+        # straight left shift
+        elif delta == (-1, 1):
+            return [- self.chunk_horisontal + self.small_horisontal, 0]
+
+        # up-left shift
+        elif delta == (-1, 0):
+            return [- self.chunk_half_horisontal + self.small_horisontal * 0.5,
+                    - self.chunk_half_vertical + self.small_vertical * 0.5]
+
+        # up-right shift
+        elif delta == (0, -1):
+            return [self.chunk_half_horisontal - self.small_horisontal * 0.5,
+                    - self.chunk_half_vertical + self.small_vertical * 0.5]
+
+        # down-right shift
+        elif delta == (1, 0):
+            return [self.chunk_half_horisontal - self.small_horisontal * 0.5,
+                    self.chunk_half_vertical - self.small_vertical * 0.5]
+
+        # No shift for the first chunk
+        else:
+            return [0, 0]
+
+    def chunk_pattern_shifts(self, chunk_is_odd):
+        """
+        Figures out how applications are shifted inside the chunk depending on its parity
+        Returns the shift in relation to chunk center, the shift of app in relation to previous app and the shift of
+        app in relation to row
+        """
+        # Given that chunks change their directions
+        if chunk_is_odd:
+            start_shift = [0, -3 * self.small_vertical]
+            shift = [- self.small_horisontal, self.small_vertical]
+            row_shift = [4.5 * self.small_horisontal, - 1.5 * self.small_vertical, ]
+        # Chunk number is even:
+        else:
+            start_shift = [0, -3 * self.small_vertical]
+            shift = [self.small_horisontal, self.small_vertical]
+            row_shift = [- 4.5 * self.small_horisontal, -1.5 * self.small_vertical]
+
+        return start_shift, shift, row_shift
+
+    def chunk_position(self, chunk_number):
+        """
+        Figures out the chunk position relative to the chunks map center, from the chunk index if it is there
+        Chunks are numbered from 0 here, -1 stands for the position before the first chunk
+        """
+        if self.is_built('chunks_index') and 0 <= chunk_number < len(self.chunks_index):
+            return self.chunks_index[chunk_number][:2]
+
+        return spiral_position(chunk_number)
+
+    def chunk_delta(self, chunk_number):
+        """
+        Figures out the chunk position delta in relation to the previous chunk, from the deltas if they are there
+        """
+        if self.is_built('coordinates_delta') and 0 <= chunk_number < len(self.coordinates_delta):
+            return self.coordinates_delta[chunk_number]
+
+        x, y = self.chunk_position(chunk_number)
+        previous_x, previous_y = self.chunk_position(chunk_number - 1)
+
+        return x - previous_x, y - previous_y
+
+    def chunk_center(self, chunk_number):
+        """
+        Figures out the chunk center coordinate in closed form, the same as adding up all the chunk shifts up to it
+        Chunks are numbered from 0 here, -1 stands for the center before the first chunk
+        """
+        x, y = self.chunk_position(chunk_number)
+        # Every chunk shift is the sum of the down-right and the down-left ones taken by delta coordinates
+        down_right = self.chunk_shift((1, 0))
+        down_left = self.chunk_shift((0, 1))
+
+        return [self.chunk_center_coordinate[0] + x * down_right[0] + y * down_left[0],
+                self.chunk_center_coordinate[1] + x * down_right[1] + y * down_left[1]]
+
+    def chunk_pattern_offsets(self, chunk_is_odd):
+        """
+        Figures out offsets of all the slots of the chunk in relation to its center
+        """
+        start_shift, shift, row_shift = self.chunk_pattern_shifts(chunk_is_odd)
+        point = start_shift
+        offsets = []
+
+        for slot in range(self.chunk_size):
+            offsets.append(point)
+            # The same walk as in place_chunks(): 4 apps per row, then jump to the next row
+            if slot % 4 != 3:
+                point = [sum(m) for m in zip(point, shift)]
+
+            else:
+                point = [sum(n) for n in zip(point, row_shift)]
+
+        return offsets
+
+    def place_applications(self):
+        """
+        Arranges all given applications in chunks depending on parity and maps coordinates
+        """
+        self.apps_coordinates = Coordinates(self.applications_amount, self.chunk_size)
+        self.spatial_index = None
+        # Built now, so place_chunks() fills it in
+        self.chunks_structure
+        self.place_chunks(0)
+
+    def place_chunks(self, first_chunk):
+        """
+        Arranges applications of the chunks starting from the given one and stores their coordinates
+        """
+        point_coordinates = self.apps_coordinates
+        # Define chunk start to shift it later after all the apps in particular chunk are placed
+        chunk_start = self.chunk_center(first_chunk - 1)
+
+        for chunk_number in range(first_chunk, self.chunks_amount):
+            chunk = self.split_chunk(chunk_number)
+            # Prepare the template for applications in chunk
+            pattern = [[0] * 4 for _ in range(3)]
+            # Reversed to pop() it later
+            items_to_place = chunk[::-1]
+            # Figure out the shift
+            chunks_shift = self.chunk_shift(self.chunk_delta(chunk_number))
+
+            chunk_is_odd = self.chunk_is_odd(chunk_number + 1)
+            # Figure out how applications are shifted inside the chunk
+            start_shift, shift, row_shift = self.chunk_pattern_shifts(chunk_is_odd)
+
+            # Shifted coordinate inside the chunk
+            pre_point = [sum(k) for k in zip(chunk_start, start_shift)]
+            # Shifted coordinate based on chunk shift from previous chunk
+            point = [sum(n) for n in zip(pre_point, chunks_shift)]
+
+            for line_number, line in enumerate(pattern):
+
+                for item_position, item in enumerate(line):
+                    # If there is something left in the list
+                    if items_to_place:
+                        # Take it out
+                        popped = items_to_place.pop()
+                        # And assign coordinates to the application
+                        pattern[line_number][item_position] = popped
+                        # And place the application into prepared template
+                        point_coordinates.place(popped, point)
+                    # If chunk order is odd and either this is the end of the row, or no more items to place
+                    if chunk_is_odd and (item_position == 3 or not items_to_place):
+                        line.reverse()
+                    # If the end of the row is not reached yet, shift by app to app relation
+                    if item_position != 3:
+                        point = [sum(m) for m in zip(point, shift)]
+                # Row end reached now, time to shift by app to row relation
+                point = [sum(n) for n in zip(point, row_shift)]
+            # Chunk ended now, time to shift chunk center by chunk to chunk relation
+            chunk_start = [sum(o) for o in zip(chunk_start, chunks_shift)]
+            # Save the structured chunk just in case, if anybody asked for the structure
+            if self.is_built('chunks_structure'):
+                self.chunks_structure[chunk_number] = pattern
+
+    def append_applications(self, amount):
+        """
+        Places given amount of applications more by continuing the spiral, the map is not rebuilt
+        Only the new chunks (and the last one, if it was not full) are placed. Expects the map to be panned
+        already, pans it again and refigures canvas dimensions
+        Returns the delta: canvas dimensions, pan offset shift and coordinates of the new applications, along with
+        the zero one if the map has it
+        """
+        coordinates = self.apps_coordinates
+        old_amount = self.applications_amount
+        old_offset = coordinates.offset
+        # The last chunk is placed again if it has zero-filled slots
+        first_chunk = old_amount // self.chunk_size
+        self.applications_amount += amount
+        self.chunks_amount = -(-self.applications_amount // self.chunk_size)
+
+        if self.spatial_index is not None and coordinates.has_zero():
+            self.spatial_index.discard(0)
+
+        # Continue the spiral, if it was built already
+        if self.is_built('coordinates_delta'):
+            self.coordinates_delta.extend(self.chunk_delta(chunk_number)
+                                          for chunk_number in range(len(self.coordinates_delta), self.chunks_amount))
+
+        if self.is_built('chunks_index'):
+
+            for chunk_number in range(len(self.chunks_index), self.chunks_amount):
+                x, y = spiral_position(chunk_number)
+                self.chunks_index.append((x, y, not (x + y) % 2))
+
+        # Now the applications themselves, if they were built already
+        if self.is_built('applications'):
+            self.applications.extend(range(old_amount + 1, self.applications_amount + 1))
+
+        for name in ('chunks', 'chunks_structure'):
+
+            if self.is_built(name):
+                chunks = getattr(self, name)
+                del chunks[first_chunk:]
+                chunks.extend(self.split_chunk(chunk_number) for chunk_number in range(first_chunk,
+                                                                                       self.chunks_amount))
+
+        del coordinates.slots[2 * first_chunk * self.chunk_size:]
+        self.tiles_cache.clear()
+        coordinates.applications_amount = self.applications_amount
+        self.place_chunks(first_chunk)
+
+        if self.spatial_index is not None:
+
+            for application in range(old_amount + 1, self.applications_amount + 1):
+                self.spatial_index.add(application)
+
+            if coordinates.has_zero():
+                self.spatial_index.add(0)
+
+        # The chunks map is only kept while it is big enough, otherwise it is dropped and the map attribute rebuilds
+        # it with fill_chunks_map() on first access
+        array_size = self.array_size
+        self.get_array_size()
+        self.locate_array_center()
+
+        if self.array_size == array_size and self.is_built('map'):
+
+            for chunk_number in range(first_chunk, self.chunks_amount):
+                x, y = self.chunk_position(chunk_number)
+                self.map[self.array_center[1] + y][self.array_center[0] + x] = chunk_number + 1
+
+        else:
+            self.__dict__.pop('map', None)
+
+        # Pan from scratch, the extent has grown
+        coordinates.offset = [0.0, 0.0]
+        self.pan_coordinates()
+        self.get_canvas_dimensions()
+        new_applications = list(range(old_amount + 1, self.applications_amount + 1))
+
+        if coordinates.has_zero():
+            new_applications.append(0)
+
+        return {'canvas_dimensions': self.canvas_dimensions,
+                'pan_offset_shift': [coordinates.offset[0] - old_offset[0], coordinates.offset[1] - old_offset[1]],
+                'application_coordinates': {application: coordinates[application]
+                                            for application in new_applications}}
+
+    @classmethod
+    def load_binary(cls, filename):
+        """
+        Loads the map laid out earlier from binary json-matrix, so it could be appended to
+        """
+        with BinaryMatrix(filename) as matrix:
+            appmap = cls(matrix.applications_amount)
+
+            if matrix.chunk_size != appmap.chunk_size:
+                raise ValueError(f'{filename} is laid out in chunks of {matrix.chunk_size}, not {appmap.chunk_size}')
+
+            appmap.get_array_size()
+            appmap.locate_array_center()
+            # The chunk lists are not built, they are built if anybody asks for them later on
+            # Full chunks are read as they are, the last one is placed again (in closed form) to get its zero-filled
+            # slots back
+            full_chunks = appmap.applications_amount // appmap.chunk_size
+            start = BinaryMatrix.header.size + 16
+            slots = array('d')
+
+            # Copied straight from the mapped file, the view is released before the file is closed
+            with memoryview(matrix.buffer)[start:start + 16 * full_chunks * appmap.chunk_size] as view:
+                slots.frombytes(view)
+
+            if sys.byteorder != 'little':
+                slots.byteswap()
+
+            appmap.apps_coordinates = Coordinates(appmap.applications_amount, appmap.chunk_size, slots,
+                                                  matrix.extent)
+            appmap.apps_coordinates.offset = list(matrix.offset)
+            appmap.canvas_dimensions = matrix.canvas_dimensions
+            appmap.place_chunks(full_chunks)
+
+        return appmap
+
+    def iter_coordinates(self):
+        """
+        Yields (application, x, y) of all the applications chunk by chunk, panned, without placing anything
+        Takes O(1) memory and needs none of the map building steps. Yields the same as
+        apps_coordinates.points() after place_applications() and pan_coordinates(), zero application included
+        """
+        offset_x, offset_y = self.get_pan_offset()
+        pattern_offsets = [self.chunk_pattern_offsets(False), self.chunk_pattern_offsets(True)]
+        down_right = self.chunk_shift((1, 0))
+        down_left = self.chunk_shift((0, 1))
+
+        for chunk_number, (x, y) in zip(range(self.chunks_amount), spiral_positions()):
+            center_x = self.chunk_center_coordinate[0] + x * down_right[0] + y * down_left[0]
+            center_y = self.chunk_center_coordinate[1] + x * down_right[1] + y * down_left[1]
+            first = chunk_number * self.chunk_size + 1
+
+            for application, (dx, dy) in zip(range(first, self.applications_amount + 1),
+                                             pattern_offsets[not (x + y) % 2]):
+                yield application, center_x + dx + offset_x, center_y + dy + offset_y
+
+        if self.applications_amount % self.chunk_size:
+            dx, dy = pattern_offsets[not sum(self.chunk_position(self.chunks_amount - 1)) % 2][-1]
+            center_x, center_y = self.chunk_center(self.chunks_amount - 1)
+
+            yield 0, center_x + dx + offset_x, center_y + dy + offset_y
+
+    def get_layout_extent(self):
+        """
+        Figures out [min_x, min_y, max_x, max_y] of the applications without placing them, None if there is none
+        Every ring of the spiral surrounds all the rings inside it, and slots of odd and even chunks stick out of the
+        chunk the same way, so only the last full ring and the ring being filled are looked at
+        """
+        if not self.applications_amount:
+            return None
+
+        last_chunk = self.chunks_amount - 1
+        # Ring k is made of 6 * k chunks starting from 3 * k * (k - 1) + 1
+        ring = 0
+
+        while 3 * ring * (ring + 1) < last_chunk:
+            ring += 1
+
+        first_chunk = 3 * (ring - 1) * (ring - 2) + 1 if ring > 1 else 0
+        pattern_offsets = [self.chunk_pattern_offsets(False), self.chunk_pattern_offsets(True)]
+        extent = None
+
+        for chunk_number in range(first_chunk, self.chunks_amount):
+            x, y = self.chunk_position(chunk_number)
+            center_x, center_y = self.chunk_center(chunk_number)
+            offsets = pattern_offsets[not (x + y) % 2]
+
+            # The last chunk may be not full, only its zero-filled slot which goes last is on the map
+            if chunk_number == last_chunk and self.applications_amount % self.chunk_size:
+                offsets = offsets[:self.applications_amount % self.chunk_size] + offsets[-1:]
+
+            for dx, dy in offsets:
+                point_x = center_x + dx
+                point_y = center_y + dy
+
+                if extent is None:
+                    extent = [point_x, point_y, point_x, point_y]
+
+                else:
+                    extent = [min(extent[0], point_x), min(extent[1], point_y),
+                              max(extent[2], point_x), max(extent[3], point_y)]
+
+        return extent
+
+    def get_pan_offset(self):
+        """
+        Figures out the offset pan_coordinates() is going to shift the coordinates by, without placing anything
+        """
+        extent = self.get_layout_extent() or [0, 0]
+
+        return [self.large_half_horisontal - min(0, extent[0]), self.large_half_vertical - min(0, extent[1])]
+
+    def get_coordinates_array(self):
+        """
+        Vectorized counterpart of place_applications(), needs NumPy
+        Computes coordinates of all the applications at once and returns (N, 2) array of floats,
+        row N - 1 holds coordinates of application N
+        """
+        return self.get_slots_array()[:self.applications_amount]
+
+    def get_slots_array(self):
+        """
+        Computes coordinates of every slot in every chunk (including zero-filled ones) as (chunks * 12, 2) array
+        """
+        try:
+            import numpy
+
+        except ImportError:
+            raise ImportError('NumPy is required by vectorized layout engine') from None
+
+        # Chunk positions straight from the spiral, the chunk lists of the map are not needed at all
+        positions = spiral_positions_array(numpy, self.chunks_amount)
+        # Chunk centers in closed form, the same as chunk_center() does. All the dimensions are multiples of 1/4,
+        # so the products and sums are exact and match place_applications() to the last bit
+        down_right = numpy.array(self.chunk_shift((1, 0)), dtype=numpy.float64)
+        down_left = numpy.array(self.chunk_shift((0, 1)), dtype=numpy.float64)
+        chunks_centers = (positions[:, 0:1] * down_right + positions[:, 1:2] * down_left +
+                          numpy.array(self.chunk_center_coordinate, dtype=numpy.float64))
+        # Chunk parity, same as in index_chunks()
+        chunks_parity = (positions.sum(axis=1) % 2 == 0).astype(numpy.int64)
+
+        # Intra-chunk offsets of all 12 slots for even (0) and odd (1) chunks
+        pattern_offsets = numpy.array([self.chunk_pattern_offsets(False), self.chunk_pattern_offsets(True)],
+                                      dtype=numpy.float64)
+        slots = chunks_centers[:, numpy.newaxis, :] + pattern_offsets[chunks_parity]
+
+        return slots.reshape(-1, 2)
+
+    def place_applications_vectorized(self):
+        """
+        Same as place_applications(), but uses NumPy to compute all the coordinates at once
+        The chunks_structure is left as is
+        """
+        slots_array = self.get_slots_array()
+        import numpy                                                  # Imported by get_slots_array() already
+        slots = array('d')
+        # Straight from the array buffer as bytes (which is just a view of it), so it is copied only once
+        slots.frombytes(slots_array.reshape(-1).view(numpy.uint8))
+        extent = None
+
+        if self.applications_amount:
+            # Same as Coordinates.measure(), but without leaving NumPy and without copying the slots once more
+            # Column by column, reducing (N, 2) array along its first axis is way slower than that
+            xs = slots_array[:self.applications_amount, 0]
+            ys = slots_array[:self.applications_amount, 1]
+            extent = [float(xs.min()), float(ys.min()), float(xs.max()), float(ys.max())]
+
+            # The zero application is folded in on its own
+            if self.applications_amount % self.chunk_size:
+                x, y = slots_array[-1].tolist()
+                extent = [min(extent[0], x), min(extent[1], y), max(extent[2], x), max(extent[3], y)]
+
+        self.apps_coordinates = Coordinates(self.applications_amount, self.chunk_size, slots, extent)
+        self.spatial_index = None
+
+    def build_spatial_index(self):
+        """
+        Builds the index for application_at() and applications_within(), it is built on the first query otherwise
+        """
+        self.spatial_index = SpatialIndex(self.apps_coordinates, self.large_half_horisontal, self.large_half_vertical)
+
+    def application_at(self, x, y):
+        """
+        Figures out the application under the point of the image, None if there is none
+        """
+        if self.spatial_index is None:
+            self.build_spatial_index()
+
+        return self.spatial_index.at(x, y)
+
+    def applications_within(self, min_x, min_y, max_x, max_y):
+        """
+        Figures out the applications which are (at least partially) in the viewport of the image, in drawing order
+        """
+        if self.spatial_index is None:
+            self.build_spatial_index()
+
+        return self.spatial_index.within(min_x, min_y, max_x, max_y)
+
+    def pan_coordinates(self):
+        """
+        Figures out minimal coordinates (there are negative ones) and shifts all the coordinates by that difference
+        This is needed for all the chunks to be visible when we draw the image
+        """
+        min_x = 0
+        min_y = 0
+        bounds = self.apps_coordinates.bounds()
+
+        if bounds:
+            min_x = min(min_x, bounds[0])
+            min_y = min(min_y, bounds[1])
+
+        # Adding this to have objects fully visible on the top and left of the image
+        min_x -= self.large_half_horisontal
+        min_y -= self.large_half_vertical
+
+        # Shifting all the coordinates by minimals
+        self.apps_coordinates.pan(- min_x, - min_y)
+
+    def get_canvas_dimensions(self):
+        """
+        Figures out final image dimensions
+        """
+        max_x = 0
+        max_y = 0
+        bounds = self.apps_coordinates.bounds()
+
+        if bounds:
+            max_x = max(max_x, bounds[2])
+            max_y = max(max_y, bounds[3])
+        # Adding this to have objects fully visible on the bottom and right of the image
+        max_x += self.large_half_horisontal
+        max_y += self.large_half_vertical
+        # Storing final dimensions for later use
+        self.canvas_dimensions = [int(max_x), int(max_y)]
+
+    def lay_out(self, layout_engine='python'):
+        """
+        Does all the steps from an empty map to the panned coordinates and canvas dimensions
+        """
+        # Could be compacted or used in chains or anything else, but for the sake of visibility:
+        self.get_array_size()
+        self.locate_array_center()
+
+        if layout_engine == 'numpy':
+            # Needs none of the chunk lists, they are built if anybody asks for them later on
+            self.place_applications_vectorized()
+
+        else:
+            self.get_coordinates_delta()
+            self.index_chunks()
+            self.fill_chunks_map()
+            self.place_applications()
+
+        self.pan_coordinates()
+        self.get_canvas_dimensions()
+
+    def to_json(self):
+        """
+        Converts coordinates and canvas dimensions to json dump string
+        """
+        data = {'canvas_dimensions': self.canvas_dimensions,
+                'application_coordinates': dict(self.apps_coordinates)}
+
+        self.json_data = json.dumps(data)
+
+    def output_json(self, filename, compress=False):
+        """
+        Streams json matrix to the file, gzipped on the fly if asked to
+        """
+        with (gzip.open(filename, 'wt') if compress else open(filename, 'w')) as out_file:
+            write_json(out_file, self.canvas_dimensions, self.apps_coordinates.points())
+
+    def output_binary(self, filename):
+        """
+        Outputs coordinates to binary json-matrix counterpart, see BinaryMatrix for the format
+        """
+        coordinates = self.apps_coordinates
+        extent = coordinates.extent or [math.nan] * 4
+        zero = coordinates[0] if coordinates.has_zero() else [math.nan, math.nan]
+        # Stored coordinates are not panned, so writing them is just dumping the array
+        placed = memoryview(coordinates.slots)[:2 * coordinates.applications_amount]
+
+        if sys.byteorder != 'little':
+            placed = array('d', placed)
+            placed.byteswap()
+
+        with open(filename, 'wb') as out_file:
+            out_file.write(BinaryMatrix.header.pack(BinaryMatrix.magic, BinaryMatrix.version, self.chunk_size,
+                                                    coordinates.applications_amount, *self.canvas_dimensions,
+                                                    *coordinates.offset, *extent))
+            out_file.write(struct.pack('<2d', zero[0] - coordinates.offset[0], zero[1] - coordinates.offset[1]))
+            out_file.write(placed)
+
+    def output_image(self, filename, workers=0):
+        """
+        Draws and outputs an image of chunks and applications
+        With workers given, the image is drawn in horizontal bands by that many processes, see output_image_banded()
+        """
+        if workers:
+            return self.output_image_banded(filename, workers)
+
+        import_pillow()
+        background_dimensions = (self.canvas_dimensions[0], self.canvas_dimensions[1])
+        # Used tint of red to indicate transparency
+        background = Image.new('RGBA', background_dimensions, (127, 0, 0, 0))
+        # 'polygon' used to get transparency by pasting the chunk over background
+        polygon_dimensions = (int(round(self.large_horisontal)), int(round(self.large_vertical)))
+        # The polygon is drawn once and then stamped over the background for every application
+        stamp = load_stamp(polygon_dimensions)
+
+        # Extract coordinates from apps_coordinates
+        for key, polygon_offset in self.polygon_offsets():
+            stamp.paste(background, str(key), polygon_offset)
+
+        background.save(filename, 'PNG')
+
+    def polygon_offsets(self):
+        """
+        Yields applications along with (0, 0) of their polygons on the image
+        """
+        for key, x, y in self.apps_coordinates.points():
+            yield key, self.polygon_offset(x, y)
+
+    def polygon_offset(self, x, y):
+        """
+        Figures out (0, 0) of the polygon centered at the point
+        """
+        return int(round(x - self.large_half_horisontal)), int(round(y - self.large_half_vertical))
+
+    def polygons_within(self, left, top, right, bottom):
+        """
+        Figures out the polygons which have to be drawn in the region of the image, in drawing order
+        Returns the list of (label, x, y) of each polygon (0, 0)
+        """
+        polygon_width = int(round(self.large_horisontal))
+        polygon_height = int(round(self.large_vertical))
+        polygons = []
+
+        # Polygon offsets are rounded, so a pixel more around is asked for to be on the safe side
+        for key in self.applications_within(left - 1, top - 1, right + 1, bottom + 1):
+            x, y = self.polygon_offset(*self.apps_coordinates[key])
+
+            if x < right and x + polygon_width > left and y < bottom and y + polygon_height > top:
+                polygons.append((str(key), x, y))
+
+        return polygons
+
+    def image_bands(self, band_height):
+        """
+        Splits the image into horizontal bands and figures out which applications each of them has to draw
+        Yields the bands ready for render_band()
+        """
+        width, height = self.canvas_dimensions
+        polygon_dimensions = (int(round(self.large_horisontal)), int(round(self.large_vertical)))
+
+        for top in range(0, height, band_height):
+            yield (top, (width, min(band_height, height - top)), polygon_dimensions,
+                   self.polygons_within(0, top, width, top + band_height))
+
+    def output_image_banded(self, filename, workers, band_height=512):
+        """
+        Draws the image in horizontal bands in a pool of processes and streams the bands to the file in order
+        The bands are compressed by the workers as well, and only twice as many bands as there are workers are
+        drawn ahead of the one being written, so only a few bands are held in memory at any time
+        """
+        import multiprocessing
+
+        pending = collections.deque()
+
+        with open(filename, 'wb') as out_file, multiprocessing.Pool(workers) as pool:
+            png = PngWriter(out_file, *self.canvas_dimensions)
+
+            for band in self.image_bands(band_height):
+                pending.append(pool.apply_async(render_band, (band,)))
+
+                if len(pending) >= 2 * workers:
+                    png.write_deflated(*pending.popleft().get())
+
+            while pending:
+                png.write_deflated(*pending.popleft().get())
+
+            png.close()
+
+    def output_tiles(self, directory, tile_size=256):
+        """
+        Outputs the image as z/x/y pyramid of tile_size x tile_size PNG tiles
+        The deepest level is the image at full scale, every level above is downsampled twice from the one below,
+        down to a single tile. Only a few tiles are held in memory at any time
+        """
+        import_pillow()
+        width, height = self.canvas_dimensions
+        zoom = self.tiles_zoom(tile_size)
+        columns = -(-width // tile_size)
+        rows = -(-height // tile_size)
+
+        for row in range(rows):
+
+            for column in range(columns):
+                tile = self.render_region(column * tile_size, row * tile_size, tile_size)
+                self.save_tile(tile, directory, zoom, column, row)
+
+        for level in range(zoom - 1, -1, -1):
+            columns = -(-columns // 2)
+            rows = -(-rows // 2)
+
+            for row in range(rows):
+
+                for column in range(columns):
+                    merged = Image.new('RGBA', (2 * tile_size, 2 * tile_size), (127, 0, 0, 0))
+
+                    for dx, dy in ((0, 0), (1, 0), (0, 1), (1, 1)):
+                        child = os.path.join(directory, str(level + 1), str(2 * column + dx), f'{2 * row + dy}.png')
+
+                        # There is no tiles past the right and the bottom of the image
+                        if os.path.exists(child):
+                            with Image.open(child) as child_tile:
+                                merged.paste(child_tile, (dx * tile_size, dy * tile_size))
+
+                    self.save_tile(merged.resize((tile_size, tile_size), Image.BOX), directory, level, column, row)
+
+    def tiles_zoom(self, tile_size):
+        """
+        Figures out the deepest level of the tile pyramid, the one with the image at full scale
+        """
+        return max(math.ceil(math.log2(max(self.canvas_dimensions) / tile_size)), 0)
+
+    def render_region(self, left, top, size):
+        """
+        Draws the size x size square of the image with (left, top) corner, the image is cut off at its right and bottom
+        """
+        import_pillow()
+        width, height = self.canvas_dimensions
+        polygon_dimensions = (int(round(self.large_horisontal)), int(round(self.large_vertical)))
+        stamp = load_stamp(polygon_dimensions)
+        # Used tint of red to indicate transparency
+        region = Image.new('RGBA', (size, size), (127, 0, 0, 0))
+
+        for text, x, y in self.polygons_within(left, top, left + size, top + size):
+            stamp.paste(region, text, (x - left, y - top))
+
+        # Polygons sticking out of the image are cut off, just like on the whole image
+        region.paste((127, 0, 0, 0), (max(min(width - left, size), 0), 0, size, size))
+        region.paste((127, 0, 0, 0), (0, max(min(height - top, size), 0), size, size))
+
+        return region
+
+    def render_tile(self, zoom, column, row, tile_size=256):
+        """
+        Draws a single tile of the pyramid output_tiles() outputs, without drawing the rest of it
+        Tiles above the deepest level are merged from the four tiles below, just like output_tiles() does, so nothing
+        bigger than a tile is ever drawn. The last few of them are cached, as tiles next to each other share the ones
+        below. Still, a tile takes as long as all the deepest tiles under it, so the caller has to limit the zoom
+        Returns None if there is no such tile
+        """
+        deepest_zoom = self.tiles_zoom(tile_size)
+
+        # There is no levels above the single tile one, nor below the full scale one
+        if not 0 <= zoom <= deepest_zoom:
+            return None
+
+        size = tile_size * 2 ** (deepest_zoom - zoom)
+
+        if not 0 <= column * size < self.canvas_dimensions[0] or \
+                not 0 <= row * size < self.canvas_dimensions[1]:
+            return None
+
+        if zoom == deepest_zoom:
+            return self.render_region(column * size, row * size, size)
+
+        key = (tile_size, zoom, column, row)
+
+        if key in self.tiles_cache:
+            self.tiles_cache.move_to_end(key)
+
+            return self.tiles_cache[key]
+
+        merged = Image.new('RGBA', (2 * tile_size, 2 * tile_size), (127, 0, 0, 0))
+
+        for dx, dy in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            child = self.render_tile(zoom + 1, 2 * column + dx, 2 * row + dy, tile_size)
+
+            # There is no tiles past the right and the bottom of the image
+            if child is not None:
+                merged.paste(child, (dx * tile_size, dy * tile_size))
+
+        tile = merged.resize((tile_size, tile_size), Image.BOX)
+        self.tiles_cache[key] = tile
+
+        if len(self.tiles_cache) > self.tiles_cache_size:
+            self.tiles_cache.popitem(last=False)
+
+        return tile
+
+    def tile_region(self, zoom, tile_size=256):
+        """
+        Figures out the side of the image square a tile of the pyramid level covers at full scale
+        """
+        return tile_size * 2 ** max(self.tiles_zoom(tile_size) - zoom, 0)
+
+    @staticmethod
+    def save_tile(tile, directory, zoom, column, row):
+        """
+        Saves a single tile of the pyramid as directory/zoom/column/row.png
+        """
+        path = os.path.join(directory, str(zoom), str(column))
+        os.makedirs(path, exist_ok=True)
+        tile.save(os.path.join(path, f'{row}.png'), 'PNG')
+
+
+class LayoutCache:
+    """
+    On-disk cache of laid out maps
+    Maps are stored as binary json-matrices named after the geometry key (derived from chunk size and dimensions the
+    layout depends on) and amount of applications. Least recently used ones are evicted once the cache is too big
+    """
+    suffix = '.bin'
+    # Share of the map the cached smaller one has to hold to be appended to, by layout engine. Appending is done in
+    # pure Python, it is about as slow as laying out with Python, and about a hundred times slower than with NumPy
+    seed_shares = {'python': 0.5, 'numpy': 0.99}
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size                                      # In bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def geometry_key(appmap):
+        """
+        Figures out the key of the map geometry, maps of the same geometry are prefixes of each other
+        """
+        import hashlib
+
+        geometry = [BinaryMatrix.version, appmap.chunk_size, appmap.large_horisontal, appmap.large_vertical,
+                    appmap.small_horisontal, appmap.small_vertical, appmap.chunk_horisontal, appmap.chunk_vertical,
+                    appmap.chunk_center_coordinate]
+
+        return hashlib.sha256(json.dumps(geometry).encode()).hexdigest()[:16]
+
+    def path(self, key, applications_amount):
+
+        return os.path.join(self.directory, f'{key}-{applications_amount}{self.suffix}')
+
+    def entries(self, key):
+        """
+        Figures out what amounts of applications are cached for the geometry
+        """
+        amounts = []
+
+        for name in os.listdir(self.directory):
+            prefix, _, rest = name.partition('-')
+
+            if prefix == key and rest.endswith(self.suffix) and rest[:-len(self.suffix)].isdigit():
+                amounts.append(int(rest[:-len(self.suffix)]))
+
+        return amounts
+
+    def load(self, applications_amount, layout_engine='python'):
+        """
+        Loads the map from the cache, None if there is nothing to load it from
+        If there is no map with that many applications, the biggest smaller one is loaded and appended to, as long
+        as it holds enough of the map for appending to be faster than laying it out with the layout engine
+        """
+        key = self.geometry_key(Map(0))
+        smaller = [amount for amount in self.entries(key) if amount <= applications_amount]
+
+        if not smaller or max(smaller) < applications_amount * self.seed_shares[layout_engine]:
+            return None
+
+        path = self.path(key, max(smaller))
+
+        try:
+            appmap = Map.load_binary(path)
+            # Used just now, so it is the last one to be evicted
+            os.utime(path)
+
+        except FileNotFoundError:                                     # Evicted by another process just now
+            return None
+
+        if appmap.applications_amount < applications_amount:
+            appmap.append_applications(applications_amount - appmap.applications_amount)
+            self.store(appmap)
+
+        return appmap
+
+    def store(self, appmap):
+        """
+        Stores the map to the cache and evicts least recently used ones if the cache is too big now
+        """
+        path = self.path(self.geometry_key(appmap), appmap.applications_amount)
+
+        if os.path.exists(path):
+            os.utime(path)
+
+            return
+
+        # Written aside and then moved, so the half-written map is never loaded, even by other processes
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        appmap.output_binary(temporary_path)
+        os.replace(temporary_path, path)
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used maps until the cache fits its size
+        """
+        entries = []
+
+        # Batch workers share the cache, so maps may be gone by the time they are looked at
+        for name in os.listdir(self.directory):
+            if name.endswith(self.suffix):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+
+                except FileNotFoundError:
+                    continue
+
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(self.directory, name)))
+
+        total_size = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            if path != keep:
+                try:
+                    os.remove(path)
+
+                except FileNotFoundError:
+                    pass
+
+                total_size -= size
+
+
+class Profiler:
+    """
+    Per-stage timers and counters of the pipeline
+    Stages are timed and events are counted by wrapping the methods doing them, the wrappers are only installed while
+    profiling, so there is no cost at all when it is off. Only this process is profiled, band and batch workers are not
+    """
+    # Class, method name, stage name. Stages called by other stages are counted in both of them
+    stages = [(Map, 'get_array_size', 'get_array_size'),
+              (Map, 'locate_array_center', 'locate_array_center'),
+              (Map, 'get_coordinates_delta', 'get_coordinates_delta'),
+              (Map, 'index_chunks', 'index_chunks'),
+              (Map, 'fill_chunks_map', 'fill_chunks_map'),
+              (Map, 'place_applications', 'place_applications'),
+              (Map, 'place_applications_vectorized', 'place_applications_vectorized'),
+              (Map, 'pan_coordinates', 'pan_coordinates'),
+              (Map, 'get_canvas_dimensions', 'get_canvas_dimensions'),
+              (Map, 'lay_out', 'lay_out'),
+              (Map, 'load_binary', 'load_binary'),
+              (Map, 'append_applications', 'append_applications'),
+              (Map, 'to_json', 'to_json'),
+              (Map, 'output_json', 'output_json'),
+              (Map, 'output_binary', 'output_binary'),
+              (Map, 'output_image', 'output_image'),
+              (Map, 'output_tiles', 'output_tiles'),
+              (LayoutCache, 'load', 'cache_load'),
+              (LayoutCache, 'store', 'cache_store')]
+    # Class, method name, counter name
+    counters = [(Map, 'chunk_is_odd', 'chunk_is_odd_calls'),
+                (TileStamp, 'paste', 'polygons_drawn'),
+                (Map, 'save_tile', 'tiles_saved')]
+
+    def __init__(self, stats_filename=None):
+        self.stats_filename = stats_filename
+        self.timings = {}                                             # Stage -> [calls, seconds]
+        self.counts = {}                                              # Counter -> count
+        self.gauges = {}                                              # Anything else worth recording, like chunks
+        self.originals = []                                           # (class, method name, method) to put back
+        self.cprofile = None
+        self.start_time = None
+
+    def wrap(self, cls, name, wrapper):
+        """
+        Replaces the method of the class with the wrapper of it, static and class methods stay what they are
+        """
+        method = cls.__dict__[name]
+        function = method.__func__ if isinstance(method, (staticmethod, classmethod)) else method
+        wrapped = functools.wraps(function)(wrapper(function))
+        self.originals.append((cls, name, method))
+        setattr(cls, name, type(method)(wrapped) if isinstance(method, (staticmethod, classmethod)) else wrapped)
+
+    def timed(self, stage):
+        """
+        Makes wrappers which add up calls and time of the stage
+        """
+        timing = self.timings.setdefault(stage, [0, 0.0])
+
+        def wrapper(function):
+
+            def timed_function(*args, **kwargs):
+                start_time = timeit.default_timer()
+
+                try:
+                    return function(*args, **kwargs)
+
+                finally:
+                    timing[0] += 1
+                    timing[1] += timeit.default_timer() - start_time
+
+            return timed_function
+
+        return wrapper
+
+    def counted(self, counter):
+        """
+        Makes wrappers which count calls
+        """
+        self.counts[counter] = 0
+
+        def wrapper(function):
+
+            def counted_function(*args, **kwargs):
+                self.counts[counter] += 1
+
+                return function(*args, **kwargs)
+
+            return counted_function
+
+        return wrapper
+
+    def start(self):
+        """
+        Installs the wrappers and starts cProfile if its stats are asked for
+        """
+        for cls, name, stage in self.stages:
+            self.wrap(cls, name, self.timed(stage))
+
+        for cls, name, counter in self.counters:
+            self.wrap(cls, name, self.counted(counter))
+
+        if self.stats_filename:
+            import cProfile
+
+            self.cprofile = cProfile.Profile()
+
+            self.cprofile.enable()
+
+        self.start_time = timeit.default_timer()
+
+    def stop(self):
+        """
+        Puts the original methods back and dumps cProfile stats if they are asked for
+        """
+        self.gauges['total_seconds'] = timeit.default_timer() - self.start_time
+
+        if self.cprofile:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.stats_filename)
+
+        for cls, name, method in reversed(self.originals):
+            setattr(cls, name, method)
+
+        self.originals = []
+
+    def measure(self, appmap):
+        """
+        Records the size of the map being profiled
+        """
+        self.gauges['applications'] = appmap.applications_amount
+        self.gauges['chunks'] = appmap.chunks_amount
+        self.gauges['canvas_dimensions'] = appmap.canvas_dimensions
+
+    def breakdown(self):
+        """
+        Returns human readable stage breakdown, slowest stages first, along with the counters
+        """
+        lines = [f'{"stage":<30} {"calls":>10} {"seconds":>12}']
+
+        for stage, (calls, seconds) in sorted(self.timings.items(), key=lambda item: -item[1][1]):
+            if calls:
+                lines.append(f'{stage:<30} {calls:>10} {seconds:>12.6f}')
+
+        lines.extend(f'{counter:<30} {count:>10}' for counter, count in self.counts.items())
+
+        return '\n'.join(lines)
+
+    def record(self):
+        """
+        Returns the metrics as json-serializable dict, for anything scraping them
+        """
+        return {'version': __VERSION__,
+                'pid': os.getpid(),
+                'stages': {stage: {'calls': calls, 'seconds': seconds}
+                           for stage, (calls, seconds) in self.timings.items() if calls},
+                'counters': self.counts,
+                **self.gauges}
+
+
+def run_batch(amounts, outputs, layout_engine='python', compress_json=False, render_workers=0, tile_size=256,
+              cache=None):
+    """
+    Lays out and outputs maps for all given amounts of applications in one go
+    Amounts are done from the smallest one, every next map is the previous one with applications appended, so the
+    spiral they share is laid out only once, unless the gap is so big that laying out from scratch is faster (see
+    LayoutCache.seed_shares). The font and tile sprites are loaded once for all the images
+    Outputs are file name templates by output kind, '{amount}' in them is replaced with the amount of applications
+    """
+    appmap = None
+
+    for amount in sorted(set(amounts)):
+        if appmap is None and cache:
+            appmap = cache.load(amount, layout_engine)
+
+        if appmap is None or appmap.applications_amount < amount * LayoutCache.seed_shares[layout_engine]:
+            appmap = Map(amount)
+            appmap.lay_out(layout_engine)
+
+        elif appmap.applications_amount < amount:
+            appmap.append_applications(amount - appmap.applications_amount)
+
+        if cache:
+            cache.store(appmap)
+
+        if outputs.get('json'):
+            appmap.output_json(outputs['json'].format(amount=amount), compress_json)
+
+        if outputs.get('binary'):
+            appmap.output_binary(outputs['binary'].format(amount=amount))
+
+        if outputs.get('image'):
+            appmap.output_image(outputs['image'].format(amount=amount), render_workers)
+
+        if outputs.get('tiles'):
+            appmap.output_tiles(outputs['tiles'].format(amount=amount), tile_size)
+
+        logger.info(f'Map of {amount} applications written')
+
+    return len(set(amounts))
+
+
+def batch_shards(amounts, workers):
+    """
+    Splits amounts of applications into contiguous runs for batch workers, so every worker still appends its maps
+    Runs are balanced by the sum of amounts, as outputting every map takes time proportional to its size
+    """
+    amounts = sorted(set(amounts))
+    # Sum of the amounts before every one of them, and of all of them last
+    sums = list(itertools.accumulate(amounts, initial=0))
+    shards = []
+    start = 0
+
+    while start < len(amounts) and workers:
+        # The rest of the amounts share the rest of the work evenly, the run ends where its sum is the closest to that
+        target = sums[start] + (sums[-1] - sums[start]) / workers
+        # Every worker left gets one amount at least
+        last_end = max(start + 1, len(amounts) - workers + 1)
+        end = bisect.bisect_left(sums, target, start + 1, last_end)
+
+        if end > start + 1 and target - sums[end - 1] <= sums[end] - target:
+            end -= 1
+
+        shards.append(amounts[start:end])
+        start = end
+        workers -= 1
+
+    return shards
+
+
+@functools.lru_cache(maxsize=4)
+def served_map(amount, layout_engine='python', cache_directory=None, cache_size=1024):
+    """
+    Lays out the map for the server, the last few of them are kept warm in every process serving them
+    """
+    cache = LayoutCache(cache_directory, cache_size * 1024 * 1024) if cache_directory else None
+    appmap = cache.load(amount, layout_engine) if cache else None
 
-    def __repr__(self):
+    if appmap is None:
+        appmap = Map(amount)
+        appmap.lay_out(layout_engine)
 
-        return f'Blocks: {self.chunks_amount}\n' \
-               f'Array size: {self.array_size} x {self.array_size}\n' \
-               f'Array center coordinates: {self.array_center}\n' \
-               f'Chunks map: {self.map}\n' \
-               f'Objects map: {self.chunks_structure}'
+        if cache:
+            cache.store(appmap)
 
-    def split_applications(self):
-        """
-        Yield successive chunk_size-sized chunks from applications
-        """
-        apps = self.applications[:]                                   # Blind-copying the list, not referencing it
-        for position in range(0, len(apps), self.chunk_size):         # Splitting the list to even-sized chunks
-            result = apps[position:position + self.chunk_size]
+    return appmap
 
-            if len(result) == 12:
-                yield result
 
-            else:
-                yield result + [0] * (self.chunk_size - len(result))  # Fills the rest of chunk with zeroes
+def serve_warm_up():
+    """
+    Loads the font and draws the tile sprites in the render worker before the first image is asked for
+    """
+    appmap = Map(0)
+    load_stamp((int(round(appmap.large_horisontal)), int(round(appmap.large_vertical))))
 
-    def get_array_size(self):
-        """
-        Figures out what the chunk map square side is, we need it for parity calculation later on
-        """
-        chunks_count = self.chunks_amount - 1                         # We need to subtract 1 so no excessive space is
-        k = 0                                                         # created in the map (i.e. no zero-border)
 
-        while chunks_count > 0:
-            k += 1
-            chunks_count -= 6 * k
+def serve_image(map_arguments):
+    """
+    Draws the whole image of the served map in the render worker, returns PNG file contents
+    """
+    buffer = io.BytesIO()
+    served_map(*map_arguments).output_image(buffer)
 
-        self.array_size = 2 * k + 1
+    return buffer.getvalue()
 
-    def locate_array_center(self):
-        """
-        Figures out the coordinates of center of chunks map array to start building chunks around it
-        """
-        coordinate = self.array_size // 2
-        self.array_center = [coordinate, coordinate]
 
-    def get_coordinates_delta(self):
-        """
-        Calculates coordinates delta for each chunk in relation to the previous chunk,
-        so we can build a chunks map like this:
+def serve_tile(map_arguments, zoom, column, row, tile_size):
+    """
+    Draws a single tile of the served map in the render worker, returns PNG file contents or None if there is no tile
+    """
+    tile = served_map(*map_arguments).render_tile(zoom, column, row, tile_size)
 
-        [0, 0, 19, 8, 9]
-        [0, 18, 7, 2, 10]
-        [17, 6, 1, 3, 11]
-        [16, 5, 4, 12, 0]
-        [15, 14, 13, 0, 0]
+    if tile is None:
+        return None
 
-        """
-        x = [0]                                                       # X differs from Y coordinate delta for the first
-        x_ones = 1                                                    # two elements, along with different order
-        x_zeroes = 1                                                  # That is due to the order the chunks are placed
-        y = [0, -1]                                                   # in
-        y_ones = 2                                                    #
-        y_zeroes = 1                                                  #
+    buffer = io.BytesIO()
+    tile.save(buffer, 'PNG')
 
-        while len(x) <= self.chunks_amount:
-            x += ([1] * x_ones + [0] * x_zeroes + [-1] * (x_ones + 1) + [0] * x_zeroes)
-            x_ones += 2
-            x_zeroes += 1
+    return buffer.getvalue()
 
-        while len(y) <= self.chunks_amount:
-            y += ([1] * y_ones + [0] * y_zeroes + [-1] * (y_ones + 1) + [0] * y_zeroes)
-            y_ones += 2
-            y_zeroes += 1
 
-        self.coordinates_delta = [delta for delta in zip(x[:self.chunks_amount], y[:self.chunks_amount])]
+class MapServer:
+    """
+    Serves maps over HTTP on TCP or Unix socket, GET requests only, parameters go in the query string:
+    /coordinates?amount=N                              - json matrix, the same as -oj outputs
+    /application?amount=N&application=K                - coordinates of a single application
+    /viewport?amount=N&left=X&top=Y&right=X&bottom=Y   - applications in the region of the image, in drawing order
+    /image?amount=N                                    - PNG image, the same as -oi outputs
+    /tile?amount=N&z=Z&x=X&y=Y                         - PNG tile of the pyramid -ot outputs
+    Maps are laid out in threads and kept warm, so the event loop is not blocked, images are drawn by worker processes
+    Amounts above max_amount (or max_image_amount for /image, the whole image is held in memory) are bad requests,
+    so are tiles covering more than max_tile_region x max_tile_region pixels of the image at full scale, as every
+    deepest tile under them has to be drawn
+    """
 
-    def fill_chunks_map(self):
+    def __init__(self, layout_engine='python', cache_directory=None, cache_size=1024, workers=0, tile_size=256,
+                 max_amount=1000000, max_image_amount=2000, max_tile_region=4096):
+        self.map_arguments = (layout_engine, cache_directory, cache_size)
+        self.tile_size = tile_size
+        self.max_amount = max_amount
+        self.max_image_amount = max_image_amount
+        self.max_tile_region = max_tile_region
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = None
+        self.loop = None
+        self.routes = {'/coordinates': self.coordinates,
+                       '/application': self.application,
+                       '/viewport': self.viewport,
+                       '/image': self.image,
+                       '/tile': self.tile}
+
+    def start_workers(self):
         """
-        Fills the map with chunk's IDs
+        Starts render workers before the event loop has any threads, with the font and sprites loaded
         """
-        # Time to prearrange template for chunks
-        self.map = [[0] * self.array_size for _ in range(self.array_size)]
-        x, y = self.array_center
+        import concurrent.futures
 
-        # Filling the map using deltas we get earlier in get_coordinates_delta()
-        for chunk, (dx, dy) in zip(range(self.chunks_amount), self.coordinates_delta):
-            x += dx
-            y += dy
-            self.map[y][x] = chunk + 1
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.workers)
 
-    def chunk_is_odd(self, chunk_number):
+        for future in [self.pool.submit(serve_warm_up) for _ in range(self.workers)]:
+            future.result()
+
+    async def laid_out(self, query, max_amount=None):
         """
-        Figures out whether the chunk is odd (and the applications in it should be in "reversed" order) or not
+        Gets the map for amount of applications asked for, laying it out in a thread if it is not warm yet
         """
-        for idx, value in enumerate(item for line in self.map for item in line):
+        amount = int(query['amount'])
+        max_amount = self.max_amount if max_amount is None else min(max_amount, self.max_amount)
 
-            # If number of chunk is not even and the chunk is not zero (there is no "zero" chunks)
-            if not idx % 2 and value == chunk_number:
-                return True
+        if amount < 0:
+            raise ValueError(f'{amount} is not a positive integer value')
 
-            elif value and value == chunk_number:
-                return False
+        if amount > max_amount:
+            raise ValueError(f'{amount} is more than {max_amount} applications allowed here')
 
-    def chunk_shift(self, delta):
-        """
-        Figures out how to shift chunk center coordinate to place applications later on
-        """
-        # Since there is only 6 possible ways to shift coordinates in the hexagonal spiral design (permutation of
-        # -1, 0 and 1 without repetition can produce only 6 different tuples):
+        return await self.loop.run_in_executor(None, served_map, amount, *self.map_arguments)
 
-        # straight right shift
-        if delta == (1, -1):
-            return [self.chunk_horisontal - self.small_horisontal, 0]
+    async def coordinates(self, query):
+        appmap = await self.laid_out(query)
+        buffer = io.StringIO()
+        await self.loop.run_in_executor(None, write_json, buffer, appmap.canvas_dimensions,
+                                        appmap.apps_coordinates.points())
 
-        # down-left shift
-        elif delta == (0, 1):
-            return [- self.chunk_half_horisontal + self.small_horisontal * 0.5,
-                    self.chunk_half_vertical - self.small_vertical * 0.5]
+        return 200, 'application/json', buffer.getvalue().encode()
 
-        # straight left shift
-        elif delta == (-1, 1):
-            return [- self.chunk_horisontal + self.small_horisontal, 0]
+    async def application(self, query):
+        appmap = await self.laid_out(query)
+        application = int(query['application'])
 
-        # up-left shift
-        elif delta == (-1, 0):
-            return [- self.chunk_half_horisontal + self.small_horisontal * 0.5,
-                    - self.chunk_half_vertical + self.small_vertical * 0.5]
+        if application not in appmap.apps_coordinates:
+            return 404, 'application/json', json.dumps({'error': f'no application {application}'}).encode()
 
-        # up-right shift
-        elif delta == (0, -1):
-            return [self.chunk_half_horisontal - self.small_horisontal * 0.5,
-                    - self.chunk_half_vertical + self.small_vertical * 0.5]
+        return 200, 'application/json', json.dumps({'application': application,
+                                                    'coordinates': appmap.apps_coordinates[application]}).encode()
 
-        # down-right shift
-        elif delta == (1, 0):
-            return [self.chunk_half_horisontal - self.small_horisontal * 0.5,
-                    self.chunk_half_vertical - self.small_vertical * 0.5]
+    async def viewport(self, query):
+        appmap = await self.laid_out(query)
+        region = [float(query[name]) for name in ('left', 'top', 'right', 'bottom')]
+        # The spatial index is built on the first query, which is too long to be done in the event loop
+        applications = await self.loop.run_in_executor(None, appmap.applications_within, *region)
+        data = {'application_coordinates': {application: appmap.apps_coordinates[application]
+                                            for application in applications}}
 
-        # No shift for the first chunk
-        else:
-            return [0, 0]
+        return 200, 'application/json', json.dumps(data).encode()
 
-    def place_applications(self):
-        """
-        Arranges all given applications in chunks depending on parity and maps coordinates
-        """
-        point_coordinates = {}
-        # Define chunk start to shift it later after all the apps in particular chunk are placed
-        chunk_start = self.chunk_center_coordinate
+    async def image(self, query):
+        appmap = await self.laid_out(query, self.max_image_amount)
+        image = await self.loop.run_in_executor(self.pool, serve_image,
+                                                (appmap.applications_amount, *self.map_arguments))
 
-        for chunk_number, chunk in enumerate(self.chunks):
-            # Prepare the template for applications in chunk
-            pattern = [[0] * 4 for _ in range(3)]
-            # Reversed to pop() it later
-            items_to_place = chunk[::-1]
-            # Figure out the shift
-            chunks_shift = self.chunk_shift(self.coordinates_delta[chunk_number])
-
-            # Given that chunks change their directions
-            if self.chunk_is_odd(chunk_number + 1):
-                # The shift in relation to chunk center
-                start_shift = [0, -3 * self.small_vertical]
-                # The shift of app in relation to previous app
-                shift = [- self.small_horisontal, self.small_vertical]
-                # Shift of app in relation to row
-                row_shift = [4.5 * self.small_horisontal, - 1.5 * self.small_vertical, ]
-            # Chunk number is even:
-            else:
-                # The shift in relation to chunk center
-                start_shift = [0, -3 * self.small_vertical]
-                # The shift of app in relation to previous app
-                shift = [self.small_horisontal, self.small_vertical]
-                # Shift of app in relation to row
-                row_shift = [- 4.5 * self.small_horisontal, -1.5 * self.small_vertical]
+        return 200, 'image/png', image
 
-            # Shifted coordinate inside the chunk
-            pre_point = [sum(k) for k in zip(chunk_start, start_shift)]
-            # Shifted coordinate based on chunk shift from previous chunk
-            point = [sum(n) for n in zip(pre_point, chunks_shift)]
+    async def tile(self, query):
+        appmap = await self.laid_out(query)
+        position = [int(query[name]) for name in ('z', 'x', 'y')]
 
-            for line_number, line in enumerate(pattern):
+        # Levels below zero have no tiles anyway
+        if position[0] >= 0 and appmap.tile_region(position[0], self.tile_size) > self.max_tile_region:
+            raise ValueError(f'tiles of zoom {position[0]} cover more than '
+                             f'{self.max_tile_region} x {self.max_tile_region} pixels')
 
-                for item_position, item in enumerate(line):
-                    # If there is something left in the list
-                    if items_to_place:
-                        # Take it out
-                        popped = items_to_place.pop()
-                        # And assign coordinates to the application
-                        pattern[line_number][item_position] = popped
-                        # And place the application into prepared template
-                        point_coordinates[popped] = point
-                    # If chunk order is odd and either this is the end of the row, or no more items to place
-                    if self.chunk_is_odd(chunk_number + 1) and (item_position == 3 or not items_to_place):
-                        line.reverse()
-                    # If the end of the row is not reached yet, shift by app to app relation
-                    if item_position != 3:
-                        point = [sum(m) for m in zip(point, shift)]
-                # Row end reached now, time to shift by app to row relation
-                point = [sum(n) for n in zip(point, row_shift)]
-            # Chunk ended now, time to shift chunk center by chunk to chunk relation
-            chunk_start = [sum(o) for o in zip(chunk_start, chunks_shift)]
-            # Save the structured chunk just in case
-            self.chunks_structure[chunk_number] = pattern
-        # Now store all the coordinates we have from application placing
-        self.apps_coordinates = point_coordinates
+        tile = await self.loop.run_in_executor(self.pool, serve_tile,
+                                               (appmap.applications_amount, *self.map_arguments),
+                                               *position, self.tile_size)
 
-    def pan_coordinates(self):
+        if tile is None:
+            return 404, 'application/json', json.dumps({'error': 'no such tile'}).encode()
+
+        return 200, 'image/png', tile
+
+    async def handle(self, reader, writer):
         """
-        Figures out minimal coordinates (there are negative ones) and shifts all the coordinates by that difference
-        This is needed for all the chunks to be visible when we draw the image
+        Handles a single HTTP request, the connection is closed after the response
         """
-        min_x = 0
-        min_y = 0
+        import http
+        import urllib.parse
 
-        for key, coordinate in self.apps_coordinates.items():
+        try:
+            request_line = (await reader.readline()).decode('latin-1')
 
-            if coordinate[0] < min_x:
-                min_x = coordinate[0]
+            # Headers are not needed, but have to be read anyway
+            while (await reader.readline()).strip():
+                pass
 
-            if coordinate[1] < min_y:
-                min_y = coordinate[1]
+            method, target, _ = request_line.split(' ', 2)
+            url = urllib.parse.urlsplit(target)
+            query = {name: values[-1] for name, values in urllib.parse.parse_qs(url.query).items()}
 
-        # Adding this to have objects fully visible on the top and left of the image
-        min_x -= self.large_half_horisontal
-        min_y -= self.large_half_vertical
+            if method != 'GET':
+                status, content_type, body = 405, 'application/json', b'{"error": "only GET is supported"}'
 
-        # Shifting all the coordinates by minimals
-        for key, coordinate in self.apps_coordinates.items():
-            self.apps_coordinates[key] = [sum(z) for z in zip(coordinate, [- min_x, - min_y])]
+            elif url.path not in self.routes:
+                status, content_type, body = 404, 'application/json', b'{"error": "no such endpoint"}'
 
-    def get_canvas_dimensions(self):
-        """
-        Figures out final image dimensions
-        """
-        max_x = 0
-        max_y = 0
+            else:
+                status, content_type, body = await self.routes[url.path](query)
 
-        for key, value in self.apps_coordinates.items():
+        except (KeyError, ValueError) as error:
+            body = json.dumps({'error': f'bad request: {error}'}).encode()
+            status, content_type = 400, 'application/json'
 
-            if value[0] > max_x:
-                max_x = value[0]
+        except Exception:
+            logger.exception('Request failed')
+            status, content_type, body = 500, 'application/json', b'{"error": "internal error"}'
 
-            if value[1] > max_y:
-                max_y = value[1]
-        # Adding this to have objects fully visible on the bottom and right of the image
-        max_x += self.large_half_horisontal
-        max_y += self.large_half_vertical
-        # Storing final dimensions for later use
-        self.canvas_dimensions = [int(max_x), int(max_y)]
+        writer.write(f'HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n'
+                     f'Content-Type: {content_type}\r\n'
+                     f'Content-Length: {len(body)}\r\n'
+                     f'Connection: close\r\n\r\n'.encode() + body)
 
-    def to_json(self):
-        """
-        Converts coordinates and canvas dimensions to json dump string
-        """
-        data = {'canvas_dimensions': self.canvas_dimensions,
-                'application_coordinates': self.apps_coordinates}
+        try:
+            await writer.drain()
 
-        self.json_data = json.dumps(data)
+        except ConnectionError:
+            pass                                                      # The client is gone, nothing to do about it
 
-    def output_json(self, filename):
-        """
-        Outputs json data to the file
-        """
-        with open(filename, 'w') as out_file:
-            out_file.write(self.json_data)
+        writer.close()
 
-    def output_image(self, filename):
+    def serve(self, address):
         """
-        Draws and outputs an image of chunks and applications
+        Serves until interrupted, address is either host:port or a path to Unix socket
         """
-        background_dimensions = (self.canvas_dimensions[0], self.canvas_dimensions[1])
-        # Used tint of red to indicate transparency
-        background = Image.new('RGBA', background_dimensions, (127, 0, 0, 0))
-        # 'polygon' used to get transparency by pasting the chunk over background
-        polygon_dimensions = (int(round(self.large_horisontal)), int(round(self.large_vertical)))
-        # If on Windows, 'Windows/fonts/' folder is looked into
-        font = ImageFont.truetype('verdana.ttf', 48)
+        import asyncio
 
-        # Extract coordinates from apps_coordinates
-        for key, value in self.apps_coordinates.items():
-            # Coordinates are inside polygon, so polygon_dimensions is used
-            point_north = (175, 0)
-            point_east = (350, 87.5)
-            point_south = (175, 175)
-            point_west = (0, 87.5)
-            # (0, 0) of each polygon
-            polygon_offset = (int(round(value[0] - self.large_half_horisontal)),
-                              int(round(value[1] - self.large_half_vertical)))
-            polygon = Image.new('RGBA', polygon_dimensions)
-            polydraw = ImageDraw.Draw(polygon)
-            # Used tint of blue to indicate transparency, resulting polygon should be purple-ish
-            polydraw.polygon([point_north, point_east, point_south, point_west],
-                             fill=(0, 0, 127, 127),
-                             outline=(0, 0, 127, 255))
-            text_string = str(key)
-            w, h = font.getsize(text_string)
-            # Draw a text with chunk number over the polygon. The text is placed in the center of polygon
-            # accounting for text dimensions
-            polydraw.text(((350 - w) / 2, ((175 - h) / 2)), text_string, fill=(255, 255, 255), font=font)
-            background.paste(polygon, polygon_offset, mask=polygon)
+        self.start_workers()
+        loop = self.loop = asyncio.get_event_loop()
 
-        background.save(filename, 'PNG')
+        if ':' in address:
+            host, _, port = address.rpartition(':')
+            server = loop.run_until_complete(asyncio.start_server(self.handle, host or None, int(port)))
+
+        else:
+            server = loop.run_until_complete(asyncio.start_unix_server(self.handle, address))
+
+        logger.info(f'Serving maps on {address}')
+
+        try:
+            # Stopped by kill just as gracefully as by Ctrl+C
+            loop.add_signal_handler(signal.SIGTERM, loop.stop)
+
+        except NotImplementedError:
+            pass                                                      # Windows event loops have no signal handlers
+
+        try:
+            loop.run_forever()
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            self.pool.shutdown()
+
+            if ':' not in address and os.path.exists(address):
+                os.remove(address)
 
 
 def main():
@@ -372,6 +2374,38 @@ def main():
 
         return int(value)
 
+    def check_positive_integer(value):
+        """
+        Input validation for sizes, which can not be zero on top of that
+        """
+        if not value.isdigit() or not int(value):
+            raise argparse.ArgumentTypeError(f'{value} is not a valid positive integer value')
+
+        return int(value)
+
+    def check_batch(value):
+        """
+        Input validation for batch amounts: comma separated integers, 'from:to[:step]' range or '@file' with integers
+        """
+        if value.startswith('@'):
+            try:
+                with open(value[1:]) as in_file:
+                    value = ','.join(in_file.read().replace(',', ' ').split())
+
+            except OSError as error:
+                raise argparse.ArgumentTypeError(f'{value[1:]} could not be read: {error.strerror}')
+
+        if ':' in value:
+            bounds = value.split(':')
+
+            if len(bounds) not in (2, 3) or not all(bound.isdigit() for bound in bounds) or bounds[2:] == ['0']:
+                raise argparse.ArgumentTypeError(f'{value} is not a valid from:to[:step] range')
+
+            # The range includes both ends, it is not Python's range after all
+            return list(range(int(bounds[0]), int(bounds[1]) + 1, int(bounds[2]) if bounds[2:] else 1))
+
+        return [check_integer(amount) for amount in value.split(',')]
+
     # Command line stuff
     arg_parser = argparse.ArgumentParser(description='Maps integer amount of applications and outputs PNG image',
                                          formatter_class=CapitalisedHelpFormatter,
@@ -391,54 +2425,270 @@ def main():
                             version=f'%(prog)s {__VERSION__}',
                             help='Show program version number and exit')
 
-    arg_parser.add_argument('-a', '--apps',
-                            dest='amount_of_applications',
-                            required=True,
+    # Not required as a group, the server takes amounts of applications from its requests
+    amounts_group = arg_parser.add_mutually_exclusive_group()
+
+    amounts_group.add_argument('-a', '--apps',
+                               dest='amount_of_applications',
+                               type=check_integer,
+                               help='Process specified amount of applications, integers only')
+
+    amounts_group.add_argument('-b', '--batch',
+                               dest='batch_amounts',
+                               type=check_batch,
+                               help='Process many amounts of applications at once: 10,20,30 or 10:1000:10 or @file,\n'
+                                    'output names should have {amount} in them then')
+
+    arg_parser.add_argument('-bw', '--batch-workers',
+                            dest='batch_workers',
+                            type=check_integer,
+                            default=0,
+                            help='Split batch between given amount of processes, 0 does it all in this one')
+
+    arg_parser.add_argument('-s', '--serve',
+                            dest='serve_address',
+                            help='Serve maps over HTTP on host:port or Unix socket path instead, see MapServer,\n'
+                                 'render workers are as many as CPUs unless -w is given')
+
+    arg_parser.add_argument('-sm', '--serve-max-amount',
+                            dest='serve_max_amount',
                             type=check_integer,
-                            help='Process specified amount of applications, integers only')
+                            default=1000000,
+                            help='Biggest amount of applications the server lays out, 1000000 by default')
+
+    arg_parser.add_argument('-si', '--serve-max-image',
+                            dest='serve_max_image',
+                            type=check_integer,
+                            default=2000,
+                            help='Biggest amount of applications the server draws whole image of, 2000 by default')
+
+    arg_parser.add_argument('-sr', '--serve-max-region',
+                            dest='serve_max_region',
+                            type=check_positive_integer,
+                            default=4096,
+                            help='Biggest side in pixels of the image square the server draws a tile of,\n'
+                                 '4096 by default')
+
+    arg_parser.add_argument('-l', '--layout-engine',
+                            dest='layout_engine',
+                            choices=('python', 'numpy'),
+                            default='python',
+                            help='Layout engine to place applications with, numpy is way faster on large maps')
+
+    arg_parser.add_argument('-r', '--resume',
+                            dest='resume_file',
+                            help='Continue the map from binary json matrix with given name, new applications only')
+
+    arg_parser.add_argument('-c', '--cache-dir',
+                            dest='cache_directory',
+                            help='Keep laid out maps in given directory and reuse them, appending if needed')
+
+    arg_parser.add_argument('-cs', '--cache-size',
+                            dest='cache_size',
+                            type=check_integer,
+                            default=1024,
+                            help='Maximum size of layout cache in megabytes, 1024 by default')
 
     arg_parser.add_argument('-oj', '--output-json',
                             dest='json_file',
-                            required=True,
                             help='Output processed applications to json matrix with given name')
 
+    arg_parser.add_argument('-z', '--gzip',
+                            dest='compress_json',
+                            action='store_true',
+                            help='Compress json matrix with gzip on the fly')
+
+    arg_parser.add_argument('-ob', '--output-binary',
+                            dest='binary_file',
+                            help='Output processed applications to binary json matrix with given name as well')
+
+    arg_parser.add_argument('-od', '--output-delta',
+                            dest='delta_file',
+                            help='Output new applications and pan offset shift to json with given name when resuming')
+
     arg_parser.add_argument('-oi', '--output-image',
                             dest='image_file',
-                            required=True,
-                            help='Output processed applications to png image with given name')
+                            help='Output processed applications to png image with given name, optional')
+
+    arg_parser.add_argument('-ot', '--output-tiles',
+                            dest='tiles_directory',
+                            help='Output processed applications to z/x/y pyramid of png tiles in given directory')
+
+    arg_parser.add_argument('-ts', '--tile-size',
+                            dest='tile_size',
+                            type=check_positive_integer,
+                            default=256,
+                            help='Size of png tiles in pixels, 256 by default')
+
+    arg_parser.add_argument('-w', '--render-workers',
+                            dest='render_workers',
+                            type=check_integer,
+                            default=0,
+                            help='Draw png image in horizontal bands with given amount of processes, 0 draws it whole')
+
+    arg_parser.add_argument('-p', '--profile',
+                            dest='profile',
+                            action='store_true',
+                            help='Log time spent in every stage, counters and json metrics record when done')
+
+    arg_parser.add_argument('-pm', '--profile-metrics',
+                            dest='metrics_file',
+                            help='Write json metrics record to file with given name instead of logging it, with -p')
+
+    arg_parser.add_argument('-ps', '--profile-stats',
+                            dest='stats_file',
+                            help='Run cProfile as well and dump pstats to file with given name, with -p')
 
     # Now, parse
     command_line = arg_parser.parse_args()
     amount_of_applications = command_line.amount_of_applications
     png_filename = command_line.image_file
     json_filename = command_line.json_file
+    layout_engine = command_line.layout_engine
+    compress_json = command_line.compress_json
+    binary_filename = command_line.binary_file
+    render_workers = command_line.render_workers
+    tiles_directory = command_line.tiles_directory
+    tile_size = command_line.tile_size
+    resume_filename = command_line.resume_file
+    delta_filename = command_line.delta_file
+    cache_directory = command_line.cache_directory
+    cache_size = command_line.cache_size
+    batch_amounts = command_line.batch_amounts
+    batch_workers = command_line.batch_workers
+    serve_address = command_line.serve_address
+    profiler = None
+
+    def report_profile():
+        """
+        Stops the profiler and logs what it has found out, if profiling
+        """
+        if profiler is None:
+            return
+
+        profiler.stop()
+        logger.info(f'Stage breakdown:\n{profiler.breakdown()}')
+
+        if command_line.stats_file:
+            logger.info(f'cProfile stats written to {command_line.stats_file}')
+
+        if command_line.metrics_file:
+            with open(command_line.metrics_file, 'w') as out_file:
+                json.dump(profiler.record(), out_file)
+
+            logger.info(f'Metrics written to {command_line.metrics_file}')
+
+        else:
+            logger.info(f'Metrics: {json.dumps(profiler.record())}')
+
+    if serve_address:
+        MapServer(layout_engine, cache_directory, cache_size, render_workers, tile_size,
+                  command_line.serve_max_amount, command_line.serve_max_image,
+                  command_line.serve_max_region).serve(serve_address)
+
+        return
+
+    if (command_line.metrics_file or command_line.stats_file) and not command_line.profile:
+        arg_parser.error('-pm/--profile-metrics and -ps/--profile-stats work with -p/--profile only')
+
+    if command_line.profile:
+        profiler = Profiler(command_line.stats_file)
+        profiler.start()
+
+    if amount_of_applications is None and batch_amounts is None:
+        arg_parser.error('one of the arguments -a/--apps -b/--batch is required')
+
+    # The image is optional, layout-only runs never import Pillow at all
+    if not json_filename:
+        arg_parser.error('the following arguments are required: -oj/--output-json')
+
+    if batch_amounts is not None:
+        outputs = {'json': json_filename, 'binary': binary_filename, 'image': png_filename, 'tiles': tiles_directory}
+
+        if resume_filename or delta_filename:
+            arg_parser.error('-r/--resume and -od/--output-delta do not work with -b/--batch')
+
+        if not all('{amount}' in output for output in outputs.values() if output):
+            arg_parser.error('output names should have {amount} in them with -b/--batch')
+
+        cache = LayoutCache(cache_directory, cache_size * 1024 * 1024) if cache_directory else None
+
+        if batch_workers:
+            import multiprocessing
+
+            # Pool workers can not have workers of their own, so images are drawn whole there. The cache is shared
+            with multiprocessing.Pool(batch_workers) as pool:
+
+                pool.starmap(run_batch, [(shard, outputs, layout_engine, compress_json, 0, tile_size, cache)
+                                         for shard in batch_shards(batch_amounts, batch_workers)])
+
+        else:
+            run_batch(batch_amounts, outputs, layout_engine, compress_json, render_workers, tile_size, cache)
+
+        report_profile()
+        total_time_sec = timeit.default_timer() - total_start_time
+        logger.info(f'Batch of {len(set(batch_amounts))} maps took {total_time_sec} seconds')
+
+        return
 
     # Fair timer for json matrix generation starts here
     matrix_start_time = timeit.default_timer()
+    appmap = None
+    delta = None
+    cache = LayoutCache(cache_directory, cache_size * 1024 * 1024) if cache_directory else None
+
+    if resume_filename:
+        # Only the applications added since the map was saved are placed
+        appmap = Map.load_binary(resume_filename)
+
+        if amount_of_applications < appmap.applications_amount:
+            arg_parser.error(f'{resume_filename} has {appmap.applications_amount} applications already')
 
-    # Init, innit?
-    appmap = Map(amount_of_applications)
+        delta = appmap.append_applications(amount_of_applications - appmap.applications_amount)
 
-    # Do stuff now. Could be compacted or used in chains or anything else, but for the sake of visibility:
-    appmap.get_array_size()
-    appmap.locate_array_center()
-    appmap.get_coordinates_delta()
-    appmap.fill_chunks_map()
-    appmap.place_applications()
-    appmap.pan_coordinates()
-    appmap.get_canvas_dimensions()
-    appmap.to_json()
+    elif cache:
+        # Laid out before, or at least some of it
+        appmap = cache.load(amount_of_applications, layout_engine)
 
-    # The json matrix is generated by now, the timer should be stopped gracefully
+    if appmap is None:
+        # Init, innit?
+        appmap = Map(amount_of_applications)
+        # Do stuff now
+        appmap.lay_out(layout_engine)
+
+        if cache:
+            cache.store(appmap)
+
+    # The json matrix is generated by now (it is streamed to the file later), the timer should be stopped gracefully
     matrix_end_time = timeit.default_timer()
 
     # Now saving the matrix to the file
-    appmap.output_json(json_filename)
+    appmap.output_json(json_filename, compress_json)
     logger.info(f'JSON matrix written to {json_filename}')
 
-    # Now generate and save the image
-    appmap.output_image(png_filename)
-    logger.info(f'PNG image written to {png_filename}')
+    if binary_filename:
+        appmap.output_binary(binary_filename)
+        logger.info(f'Binary matrix written to {binary_filename}')
+
+    if delta_filename and delta is not None:
+        with open(delta_filename, 'w') as out_file:
+            json.dump(delta, out_file)
+
+        logger.info(f'JSON matrix delta written to {delta_filename}')
+
+    # Now generate and save the image, if asked for
+    if png_filename:
+        appmap.output_image(png_filename, render_workers)
+        logger.info(f'PNG image written to {png_filename}')
+
+    if tiles_directory:
+        appmap.output_tiles(tiles_directory, tile_size)
+        logger.info(f'PNG tiles written to {tiles_directory}')
+
+    if profiler:
+        profiler.measure(appmap)
+
+    report_profile()
 
     # Calc matrix generation time and log it to console
     generation_time_sec = matrix_end_time - matrix_start_time
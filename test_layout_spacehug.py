@@ -0,0 +1,181 @@
+# Tests of test_case_spacehug closed forms and shortcuts against brute-force references
+import itertools
+import unittest
+
+import test_case_spacehug
+from test_case_spacehug import Map
+
+try:
+    import numpy
+except ImportError:                                                   # NumPy tests are skipped without it
+    numpy = None
+
+SIZES = list(range(0, 150)) + [1524, 5000]
+
+
+def brute_positions(chunks_amount):
+    """
+    Chunk positions relative to the chunks map center, by adding up the deltas get_coordinates_delta() builds
+    """
+    appmap = Map(chunks_amount * 12)
+    appmap.get_coordinates_delta()
+    x = y = 0
+    positions = []
+
+    for dx, dy in appmap.coordinates_delta:
+        x += dx
+        y += dy
+        positions.append((x, y))
+
+    return positions
+
+
+def brute_chunk_is_odd(appmap, chunk_number):
+    """
+    Chunk parity the way it used to be figured out: the chunk is odd if its flat index in the chunks map is even
+    """
+    flat_map = list(itertools.chain.from_iterable(appmap.map))
+
+    return not flat_map.index(chunk_number) % 2
+
+
+def brute_slots(appmap):
+    """
+    Coordinates of every slot of every chunk, by walking the chunks one shift at a time from the first chunk center
+    """
+    center = appmap.chunk_center_coordinate
+    slots = []
+
+    for chunk_number, delta in enumerate(appmap.coordinates_delta):
+        center = [sum(pair) for pair in zip(center, appmap.chunk_shift(delta))]
+
+        for offset in appmap.chunk_pattern_offsets(brute_chunk_is_odd(appmap, chunk_number + 1)):
+            slots.extend(sum(pair) for pair in zip(center, offset))
+
+    return slots
+
+
+def laid_out(applications_amount, layout_engine='python'):
+    appmap = Map(applications_amount)
+    appmap.lay_out(layout_engine)
+
+    return appmap
+
+
+class SpiralTest(unittest.TestCase):
+
+    def test_spiral_position(self):
+        positions = brute_positions(2000)
+
+        self.assertEqual(test_case_spacehug.spiral_position(-1), (0, 0))
+
+        for chunk_number, position in enumerate(positions):
+            self.assertEqual(test_case_spacehug.spiral_position(chunk_number), position)
+
+    def test_spiral_positions(self):
+        positions = brute_positions(2000)
+
+        self.assertEqual(list(itertools.islice(test_case_spacehug.spiral_positions(), len(positions))), positions)
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_spiral_positions_array(self):
+        positions = brute_positions(2000)
+
+        for count in (0, 1, 2, 7, 8, 19, 20, 2000):
+            self.assertEqual([tuple(position) for position in
+                              test_case_spacehug.spiral_positions_array(numpy, count).tolist()], positions[:count])
+
+
+class LayoutTest(unittest.TestCase):
+
+    def test_chunk_is_odd(self):
+        for applications_amount in SIZES:
+            appmap = laid_out(applications_amount)
+            # Once from the chunk index and once in closed form
+            bare = Map(applications_amount)
+
+            for chunk_number in range(1, appmap.chunks_amount + 1):
+                self.assertEqual(appmap.chunk_is_odd(chunk_number), brute_chunk_is_odd(appmap, chunk_number))
+                self.assertEqual(bare.chunk_is_odd(chunk_number), brute_chunk_is_odd(appmap, chunk_number))
+
+    def test_place_applications(self):
+        for applications_amount in SIZES:
+            appmap = laid_out(applications_amount)
+
+            self.assertEqual(appmap.apps_coordinates.slots.tolist(), brute_slots(appmap))
+
+    def test_layout_extent(self):
+        for applications_amount in SIZES:
+            appmap = laid_out(applications_amount)
+            points = [appmap.apps_coordinates[application] for application in appmap.apps_coordinates]
+            dx, dy = appmap.apps_coordinates.offset
+            extent = [min(x for x, _ in points) - dx, min(y for _, y in points) - dy,
+                      max(x for x, _ in points) - dx, max(y for _, y in points) - dy] if points else None
+
+            self.assertEqual(Map(applications_amount).get_layout_extent(), extent)
+            self.assertEqual(Map(applications_amount).get_pan_offset(), list(appmap.apps_coordinates.offset))
+
+    def test_iter_coordinates(self):
+        for applications_amount in SIZES:
+            self.assertEqual(list(Map(applications_amount).iter_coordinates()),
+                             list(laid_out(applications_amount).apps_coordinates.points()))
+
+    def test_append_applications(self):
+        for applications_amount, amount in itertools.product((0, 1, 11, 12, 13, 150), (0, 1, 11, 12, 13, 500)):
+            appmap = laid_out(applications_amount)
+            appmap.append_applications(amount)
+            fresh = laid_out(applications_amount + amount)
+
+            self.assertEqual(list(appmap.apps_coordinates.points()), list(fresh.apps_coordinates.points()))
+            self.assertEqual(appmap.canvas_dimensions, fresh.canvas_dimensions)
+            self.assertEqual(appmap.map, fresh.map)
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_vectorized_layout(self):
+        for applications_amount in SIZES:
+            appmap = laid_out(applications_amount)
+            vectorized = laid_out(applications_amount, 'numpy')
+
+            self.assertEqual(vectorized.apps_coordinates.slots, appmap.apps_coordinates.slots)
+            self.assertEqual(vectorized.apps_coordinates.extent, appmap.apps_coordinates.extent)
+            self.assertEqual(vectorized.canvas_dimensions, appmap.canvas_dimensions)
+            # The chunk lists are built on demand, the same as the Python engine builds them
+            self.assertEqual(vectorized.map, appmap.map)
+            self.assertEqual(vectorized.chunks_index, appmap.chunks_index)
+
+
+class StampTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            cls.font = test_case_spacehug.load_font()
+
+        except OSError:
+            raise unittest.SkipTest('verdana.ttf is not available')
+
+    def test_paste(self):
+        from PIL import Image, ImageDraw
+
+        appmap = laid_out(150)
+        dimensions = (int(round(appmap.large_horisontal)), int(round(appmap.large_vertical)))
+        stamp = test_case_spacehug.TileStamp(self.font, dimensions)
+        stamped = Image.new('RGBA', tuple(appmap.canvas_dimensions), (127, 0, 0, 0))
+        drawn = Image.new('RGBA', tuple(appmap.canvas_dimensions), (127, 0, 0, 0))
+
+        for application, offset in appmap.polygon_offsets():
+            stamp.paste(stamped, str(application), offset)
+            # The way every polygon used to be drawn from scratch
+            polygon = Image.new('RGBA', dimensions)
+            draw = ImageDraw.Draw(polygon)
+            draw.polygon([(175, 0), (350, 87.5), (175, 175), (0, 87.5)], fill=(0, 0, 127, 127),
+                         outline=(0, 0, 127, 255))
+            w, h = self.font.getsize(str(application))
+            draw.text(((350 - w) / 2, (175 - h) / 2), str(application), fill=(255, 255, 255), font=self.font)
+            drawn.paste(polygon, offset, mask=polygon)
+
+        self.assertEqual(stamped.tobytes(), drawn.tobytes())
+
+
+if __name__ == '__main__':
+    unittest.main()